@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+#
+# Generate synthetic CloudTrail log files, and benchmark cloudtrail-watch-for-reboot.py against them
+# with local stand-ins for S3, EC2 and SNS
+#
+
+from __future__ import print_function
+import argparse
+import collections
+import contextlib
+import datetime
+import gzip
+import importlib.util
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from botocore.awsrequest import AWSResponse
+from botocore.handlers import BUILTIN_HANDLERS
+
+WATCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cloudtrail-watch-for-reboot.py')
+
+BUCKET = 'benchmark-trail'
+ACCOUNT = '123456789012'
+REGION = 'us-west-2'
+TOPIC_ARN = f'arn:aws:sns:{REGION}:{ACCOUNT}:benchmark-alerts'
+
+# Event names generated by default, and their relative weights
+DEFAULT_MIX = ('DescribeInstances=30,AssumeRole=20,GetObject=15,PutObject=5,Decrypt=15,DescribeSecurityGroups=5,'
+               'CreateTags=4,StartInstances=2,StopInstances=2,ConsoleLogin=1,AuthorizeSecurityGroupIngress=1')
+
+# Source of each event name that can be generated
+EVENT_SOURCES = {
+    'AssumeRole': 'sts.amazonaws.com',
+    'AuthorizeSecurityGroupIngress': 'ec2.amazonaws.com',
+    'ConsoleLogin': 'signin.amazonaws.com',
+    'CreateTags': 'ec2.amazonaws.com',
+    'Decrypt': 'kms.amazonaws.com',
+    'DeleteTrail': 'cloudtrail.amazonaws.com',
+    'DescribeInstances': 'ec2.amazonaws.com',
+    'DescribeSecurityGroups': 'ec2.amazonaws.com',
+    'GetObject': 's3.amazonaws.com',
+    'PutObject': 's3.amazonaws.com',
+    'RebootInstances': 'ec2.amazonaws.com',
+    'StartInstances': 'ec2.amazonaws.com',
+    'StopInstances': 'ec2.amazonaws.com',
+    'TerminateInstances': 'ec2.amazonaws.com',
+}
+
+# Events whose requestParameters list instances
+INSTANCE_EVENTS = ('RebootInstances', 'StartInstances', 'StopInstances', 'TerminateInstances', 'CreateTags')
+
+# Phases of the watcher that are timed, and the API operation that belongs to each
+PHASES = ('download', 'decompress', 'parse', 'match', 'enrich', 'publish')
+PHASE_OPERATIONS = {'GetObject': 'download', 'DescribeInstances': 'enrich', 'PublishBatch': 'publish'}
+
+#
+# Helper Functions
+#
+
+def parse_mix(mix):
+    """ Parse "Name=weight,..." into a list of event names and a list of their weights """
+    names, weights = [], []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in EVENT_SOURCES:
+            print(f"\nCan't generate {name} events.  Choose from: {', '.join(sorted(EVENT_SOURCES))}\n")
+            raise SystemExit
+        names.append(name)
+        weights.append(float(weight or 1))
+    return names, weights
+
+
+def instance_ids(count):
+    return [f"i-{n:017x}" for n in range(1, count + 1)]
+
+
+def instance_tags(instance_id, tagged_fraction):
+    """ The tags of a generated instance: a Name, and for tagged_fraction of them an alert topic """
+    number = int(instance_id[2:], 16)
+    tags = {'Name': f"server-{number}"}
+    if (number * 7919) % 1000 < tagged_fraction * 1000:
+        tags['alert_topic_arn'] = TOPIC_ARN
+    return tags
+
+
+def request_parameters(rng, event_name, instances, max_instances):
+    """ Plausible requestParameters for an event """
+    if event_name in INSTANCE_EVENTS:
+        chosen = rng.sample(instances, min(len(instances), rng.randint(1, max_instances)))
+        if event_name == 'CreateTags':
+            return {'resourcesSet': {'items': [{'resourceId': i} for i in chosen]},
+                    'tagSet': {'items': [{'key': 'owner', 'value': 'benchmark'}]}}
+        return {'instancesSet': {'items': [{'instanceId': i} for i in chosen]}}
+    if event_name == 'DescribeInstances':
+        return {'instancesSet': {}, 'filterSet': {'items': [{'name': 'tag:Name', 'valueSet': {'items': [{'value': 'web'}]}}]}}
+    if event_name in ('DescribeSecurityGroups', 'AuthorizeSecurityGroupIngress'):
+        cidr = '0.0.0.0/0' if rng.random() < 0.2 else '10.0.0.0/8'
+        return {'groupId': f"sg-{rng.getrandbits(68):017x}",
+                'ipPermissions': {'items': [{'ipProtocol': 'tcp', 'fromPort': 22, 'toPort': 22,
+                                             'ipRanges': {'items': [{'cidrIp': cidr}]}}]}}
+    if event_name == 'AssumeRole':
+        return {'roleArn': f"arn:aws:iam::{ACCOUNT}:role/role-{rng.randint(1, 20)}",
+                'roleSessionName': f"session-{rng.getrandbits(32):08x}", 'durationSeconds': 3600}
+    if event_name in ('GetObject', 'PutObject'):
+        return {'bucketName': 'data-bucket', 'key': f"objects/{rng.getrandbits(64):016x}.json",
+                'Host': 'data-bucket.s3.amazonaws.com'}
+    if event_name == 'Decrypt':
+        return {'encryptionAlgorithm': 'SYMMETRIC_DEFAULT',
+                'encryptionContext': {'aws:lambda:FunctionArn': f"arn:aws:lambda:{REGION}:{ACCOUNT}:function:fn"}}
+    if event_name == 'DeleteTrail':
+        return {'name': 'management-events'}
+    return None
+
+
+def generate_records(rng, record_count, names, weights, reboot_fraction, instances, max_instances, day):
+    """ Return record_count CloudTrail records from the given day, in eventTime order """
+    day_start = datetime.datetime.combine(day, datetime.time(), tzinfo=datetime.timezone.utc)
+    records = []
+    for _ in range(record_count):
+        event_name = 'RebootInstances' if rng.random() < reboot_fraction else rng.choices(names, weights)[0]
+        user = f"user-{rng.randint(1, 50)}"
+        records.append({
+            'eventVersion': '1.08',
+            'userIdentity': {
+                'type': 'IAMUser',
+                'principalId': f"AIDA{rng.getrandbits(64):016X}",
+                'arn': f"arn:aws:iam::{ACCOUNT}:user/{user}",
+                'accountId': ACCOUNT,
+                'accessKeyId': f"AKIA{rng.getrandbits(64):016X}",
+                'userName': user,
+            },
+            'eventTime': (day_start + datetime.timedelta(seconds=rng.randrange(86400))).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'eventSource': EVENT_SOURCES[event_name],
+            'eventName': event_name,
+            'awsRegion': REGION,
+            'sourceIPAddress': f"203.0.113.{rng.randint(1, 254)}",
+            'userAgent': 'aws-cli/2.15.0 Python/3.11.6 Linux/6.1 exe/x86_64',
+            'requestParameters': request_parameters(rng, event_name, instances, max_instances),
+            'responseElements': None,
+            'requestID': str(uuid.UUID(int=rng.getrandbits(128))),
+            'eventID': str(uuid.UUID(int=rng.getrandbits(128))),
+            'readOnly': event_name.startswith(('Describe', 'Get')),
+            'eventType': 'AwsApiCall',
+            'managementEvent': True,
+            'recipientAccountId': ACCOUNT,
+            'eventCategory': 'Management',
+        })
+    records.sort(key=lambda r: r['eventTime'])
+    return records
+
+
+def generate_log_files(directory, file_count, record_count, mix, reboot_fraction, instance_count, max_instances, seed):
+    """
+    Write gzipped CloudTrail log files into directory, laid out as a trail lays them out in S3
+    :return: list of the keys (paths relative to directory) of the log files
+    """
+    rng = random.Random(seed)
+    names, weights = parse_mix(mix)
+    instances = instance_ids(instance_count)
+    day = datetime.date(2018, 12, 4)
+    keys = []
+    for file_number in range(file_count):
+        key = (f"AWSLogs/{ACCOUNT}/CloudTrail/{REGION}/{day:%Y/%m/%d}/"
+               f"{ACCOUNT}_CloudTrail_{REGION}_{day:%Y%m%d}T{file_number % 24:02d}{file_number // 24 % 60:02d}Z_"
+               f"{rng.getrandbits(64):016X}.json.gz")
+        records = generate_records(rng, record_count, names, weights, reboot_fraction, instances, max_instances, day)
+        path = os.path.join(directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, 'wt') as f:
+            json.dump({'Records': records}, f, separators=(',', ':'))
+        keys.append(key)
+    return keys
+
+
+class RawBody(io.BytesIO):
+    """ The raw stream of a stubbed response, read by botocore either whole or a chunk at a time """
+
+    def stream(self, **kwargs):
+        yield self.getvalue()
+
+
+class LocalAws(object):
+    """
+    botocore before-send handler that stands in for S3, EC2 and SNS, so the watcher never leaves the
+    process: GetObject serves the generated log files from disk, DescribeInstances knows every
+    generated instance, and PublishBatch accepts every message.  Counts the calls of each operation.
+    """
+
+    def __init__(self, directory, tagged_fraction):
+        self.directory = directory
+        self.tagged_fraction = tagged_fraction
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, request, event_name, **kwargs):
+        service = event_name.split('.')[1]
+        if service == 's3':
+            return self.get_object(request)
+        query = urllib.parse.parse_qs(request.body.decode('utf-8') if isinstance(request.body, bytes) else request.body)
+        if service == 'ec2' and query.get('Action') == ['DescribeInstances']:
+            return self.describe_instances(request, query)
+        if service == 'sns' and query.get('Action') == ['PublishBatch']:
+            return self.publish_batch(request, query)
+        raise ValueError(f"The local stand-in for {service} does not support {query.get('Action')}")
+
+    def count(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+
+    def get_object(self, request):
+        self.count('GetObject')
+        path = urllib.parse.unquote(urllib.parse.urlparse(request.url).path).lstrip('/')
+        if path.startswith(BUCKET + '/'):
+            path = path[len(BUCKET) + 1:]
+        with open(os.path.join(self.directory, path), 'rb') as f:
+            body = f.read()
+        return AWSResponse(request.url, 200, {'content-length': str(len(body))}, RawBody(body))
+
+    def describe_instances(self, request, query):
+        self.count('DescribeInstances')
+        requested = [values[0] for name, values in query.items() if name.startswith('Filter.1.Value.')]
+        items = ''
+        for instance_id in requested:
+            tags = ''.join(f"<item><key>{k}</key><value>{v}</value></item>"
+                           for k, v in instance_tags(instance_id, self.tagged_fraction).items())
+            items += f"<item><instanceId>{instance_id}</instanceId><tagSet>{tags}</tagSet></item>"
+        body = ('<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+                '<requestId>benchmark</requestId><reservationSet><item><reservationId>r-benchmark</reservationId>'
+                f'<instancesSet>{items}</instancesSet></item></reservationSet></DescribeInstancesResponse>')
+        return AWSResponse(request.url, 200, {}, RawBody(body.encode('utf-8')))
+
+    def publish_batch(self, request, query):
+        self.count('PublishBatch')
+        ids = [values[0] for name, values in query.items()
+               if name.startswith('PublishBatchRequestEntries.member.') and name.endswith('.Id')]
+        members = ''.join(f"<member><Id>{i}</Id><MessageId>{uuid.uuid4()}</MessageId></member>" for i in ids)
+        body = ('<PublishBatchResponse xmlns="http://sns.amazonaws.com/doc/2010-03-31/"><PublishBatchResult>'
+                f'<Successful>{members}</Successful><Failed/></PublishBatchResult>'
+                '<ResponseMetadata><RequestId>benchmark</RequestId></ResponseMetadata></PublishBatchResponse>')
+        return AWSResponse(request.url, 200, {}, RawBody(body.encode('utf-8')))
+
+
+def run_watcher(directory, keys, batch_size, workers, tagged_fraction, verbose, results):
+    """ Run the watcher over every log file, in this (child) process, and put its numbers on the results queue """
+    os.environ['AWS_ACCESS_KEY_ID'] = 'benchmark'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'benchmark'
+    os.environ['AWS_DEFAULT_REGION'] = REGION
+    os.environ['AWS_REGION'] = REGION
+    os.environ['LOG_FILE_WORKERS'] = str(workers)
+    os.environ.pop('AWS_PROFILE', None)
+
+    local_aws = LocalAws(directory, tagged_fraction)
+    for service in ('s3', 'ec2', 'sns'):
+        BUILTIN_HANDLERS.insert(0, (f'before-send.{service}', local_aws))
+
+    spec = importlib.util.spec_from_file_location('cloudtrail_watch', WATCHER)
+    watcher = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(watcher)
+    if not verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    # the watcher resets its METRICS at the start of each invocation, so they are added up after each one
+    watcher.METRICS.reset()
+    phase_seconds = collections.Counter()
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.perf_counter()
+    for batch_start in range(0, len(keys), batch_size):
+        event = {'Records': [
+            {'eventSource': 'aws:s3', 's3': {'bucket': {'name': BUCKET}, 'object': {'key': key}}}
+            for key in keys[batch_start:batch_start + batch_size]
+        ]}
+        watcher.main(event)
+        phase_seconds.update(watcher.METRICS.seconds)
+    elapsed = time.perf_counter() - start_time
+
+    results.put({
+        'seconds': elapsed,
+        'phases': {phase: phase_seconds[phase] for phase in PHASES},
+        'calls': dict(local_aws.calls),
+        'baseline_rss': baseline_rss,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+
+def benchmark(directory, keys, batch_size, workers, tagged_fraction, verbose):
+    """ Run the watcher in a fresh process, so each run's peak RSS and caches are its own """
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=run_watcher,
+                              args=(directory, keys, batch_size, workers, tagged_fraction, verbose, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        print(f"\nThe watcher failed (exit code {process.exitcode}).  Use --verbose to see its output.\n")
+        raise SystemExit
+    return results.get()
+
+
+def print_report(runs, record_count):
+    """ Print a line per run, then the time and API calls per record of each phase, averaged over the runs """
+    print('Run  Seconds  Records/sec  Peak RSS MB (over baseline)')
+    print('------------------------------------------------------')
+    for number, run in enumerate(runs, start=1):
+        # ru_maxrss is in kilobytes on Linux
+        print(f"{number:>3}  {run['seconds']:>7.2f}  {record_count / run['seconds']:>11.0f}  "
+              f"{run['peak_rss'] / 1024:>11.1f} ({(run['peak_rss'] - run['baseline_rss']) / 1024:.1f})")
+    print('------------------------------------------------------')
+    print(f"Median: {record_count / statistics.median(run['seconds'] for run in runs):.0f} records/sec")
+    print()
+
+    phase_seconds = {phase: statistics.mean(run['phases'][phase] for run in runs) for phase in PHASES}
+    total = sum(phase_seconds.values()) or 1
+    calls = collections.Counter()
+    for run in runs:
+        calls.update(run['calls'])
+
+    print('Phase        Seconds   Share   us/record   API calls/record')
+    print('------------------------------------------------------------')
+    for phase in PHASES:
+        operations = [op for op, op_phase in PHASE_OPERATIONS.items() if op_phase == phase]
+        phase_calls = sum(calls[op] for op in operations) / len(runs)
+        calls_text = f"{phase_calls / record_count:.6f} ({', '.join(operations)})" if operations else '-'
+        print(f"{phase:<11}{phase_seconds[phase]:>9.3f}  {phase_seconds[phase] / total:>6.1%}  "
+              f"{phase_seconds[phase] / record_count * 1e6:>10.2f}   {calls_text}")
+    print('------------------------------------------------------------')
+    print('(phase seconds are summed over the worker threads)')
+
+
+#
+# Main
+#
+
+help_description = '''
+Generate realistic, gzipped CloudTrail log files, and benchmark cloudtrail-watch-for-reboot.py against
+them.  The watcher runs in a fresh process for each run, with S3, EC2 and SNS answered in memory by local
+stand-ins, so nothing leaves the machine.  Reports records/sec and peak RSS for each run, and the time and
+API calls per record of each phase: download, decompress, parse, match, enrich (tag lookups) and publish.
+
+---------------------------------------------------------------------------
+Examples:
+
+    20 log files of 5,000 records each, 3 runs:
+
+        ./cloudtrail-watch-benchmark.py --files 20 --records 5000
+
+    Many reboots of many instances, in SQS sized batches of 10 log files:
+
+        ./cloudtrail-watch-benchmark.py --reboot-fraction 0.1 --instances 5000 --max-instances 20 --batch 10
+
+    Only generate the log files, e.g. to try the watcher's --local-dir backfill on them:
+
+        ./cloudtrail-watch-benchmark.py --generate ./trail-logs --files 100
+
+---------------------------------------------------------------------------
+
+'''
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description=help_description)
+
+parser.add_argument(
+    '--files',
+    type=int,
+    default=20,
+    help='Number of log files to generate (default 20)')
+
+parser.add_argument(
+    '--records',
+    type=int,
+    default=5000,
+    help='Number of records in each log file (default 5000)')
+
+parser.add_argument(
+    '--mix',
+    default=DEFAULT_MIX,
+    help='Comma separated event names and their relative weights, e.g. DescribeInstances=30,AssumeRole=20\n'
+         f'(default {DEFAULT_MIX})\n')
+
+parser.add_argument(
+    '--reboot-fraction',
+    type=float,
+    default=0.01,
+    help='Fraction of the records that are RebootInstances events, on top of --mix (default 0.01)')
+
+parser.add_argument(
+    '--instances',
+    type=int,
+    default=1000,
+    help='Number of distinct instances the events refer to (default 1000)')
+
+parser.add_argument(
+    '--max-instances',
+    type=int,
+    default=3,
+    help='Most instances in one event (default 3)')
+
+parser.add_argument(
+    '--tagged-fraction',
+    type=float,
+    default=0.5,
+    help='Fraction of the instances with an alert_topic_arn tag (default 0.5)')
+
+parser.add_argument(
+    '--seed',
+    type=int,
+    default=0,
+    help='Random seed (default 0)')
+
+parser.add_argument(
+    '--generate',
+    help='Write the log files into this directory and stop, without benchmarking')
+
+parser.add_argument(
+    '--batch',
+    type=int,
+    default=1,
+    help='Number of log files in each event passed to the watcher (default 1)')
+
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=1,
+    help='LOG_FILE_WORKERS for the watcher (default 1, which keeps the phase times easy to read)')
+
+parser.add_argument(
+    '--repeat',
+    type=int,
+    default=3,
+    help='Number of times to run the benchmark (default 3)')
+
+parser.add_argument(
+    '--verbose',
+    action='store_true',
+    help='Show the log output of the watcher')
+
+args = parser.parse_args()
+
+if min(args.files, args.records, args.instances, args.max_instances, args.batch, args.workers, args.repeat) < 1:
+    print("\n--files, --records, --instances, --max-instances, --batch, --workers and --repeat must be at least 1.\n")
+    raise SystemExit
+
+if not (0 <= args.reboot_fraction <= 1 and 0 <= args.tagged_fraction <= 1):
+    print("\n--reboot-fraction and --tagged-fraction must be between 0 and 1.\n")
+    raise SystemExit
+
+with contextlib.ExitStack() as stack:
+    directory = args.generate or stack.enter_context(tempfile.TemporaryDirectory())
+
+    print(f"Generating {args.files} log files of {args.records} records")
+    keys = generate_log_files(directory, args.files, args.records, args.mix, args.reboot_fraction,
+                              args.instances, args.max_instances, args.seed)
+    size = sum(os.path.getsize(os.path.join(directory, key)) for key in keys)
+    print(f"Wrote {size / 1024 / 1024:.1f} MB to {directory}")
+
+    if args.generate:
+        raise SystemExit
+
+    print(f"Running the watcher {args.repeat} times, {args.batch} log files per event")
+    try:
+        runs = [
+            benchmark(directory, keys, args.batch, args.workers, args.tagged_fraction, args.verbose)
+            for _ in range(args.repeat)
+        ]
+    except KeyboardInterrupt:
+        print("\nInterrupted.\n")
+        raise SystemExit
+
+    print()
+    print_report(runs, args.files * args.records)
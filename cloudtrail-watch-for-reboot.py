@@ -37,18 +37,80 @@
 #             "Resource": [
 #                 "<SNS Topic ARN>"
 #             ]
+#         },
+#         {
+#             "Effect": "Allow",
+#             "Action": [
+#                 "dynamodb:PutItem",
+#                 "dynamodb:UpdateItem",
+#                 "dynamodb:DeleteItem"
+#             ],
+#             "Resource": [
+#                 "<Processed log files table ARN, if PROCESSED_STORE is dynamodb:>"
+#             ]
 #         }
 #     ]
 # }
+#
+# The events to watch for are described by the rules in cloudtrail-watch-rules.json (deploy it
+# alongside this file, or point the RULES_FILE environment variable at another one).  Each rule has:
+#
+#     name          short name used in the logs
+#     title         heading of the alert message
+#     eventSource   e.g. "ec2.amazonaws.com"
+#     eventName     an event name, or a list of them
+#     match         optional list of {"field": path, "op": op, "value": value} predicates, all of
+#                   which must hold.  ops: equals, not_equals, in, not_in, prefix, contains, regex,
+#                   exists, absent
+#     resources     path to the ID(s) of the affected resources, e.g.
+#                   "requestParameters.instancesSet.items[].instanceId"
+#     resourceType  "instance" to look up the Name tag (and alert tag) of each resource
+#     alert         {"tag": key} to alert the SNS topic in that tag of the instance, and/or
+#                   {"topic": arn} for a fixed topic, which may use ${ENVIRONMENT_VARIABLES}
+#
+# Paths are dotted field names; a "[]" suffix visits every element of a list, and a predicate
+# holds if any of the values at its path satisfy it.
+#
+# The function can be invoked by S3 notifications directly, or through an SQS queue (which they may
+# reach through SNS).  With SQS, enable ReportBatchItemFailures on the event source mapping, so that
+# only the messages whose log files failed are retried.
+#
+# Each invocation logs the time spent downloading, decompressing, parsing, matching, looking up tags and
+# publishing, with counts of the records scanned, matched and alerted, as CloudWatch Embedded Metric
+# Format, so that they show up as metrics in the METRICS_NAMESPACE namespace (CloudTrailWatch).
+#
+# S3 delivers notifications at least once, so the same log file can arrive again.  To skip log files
+# that were already processed (before downloading them), set PROCESSED_STORE to one of:
+#
+#     dynamodb:<table>   a DynamoDB table with a string partition key "id"; enable TTL on "expires"
+#     sqlite:<path>      a local SQLite database
+#     memory             only remembered across warm invocations of the same Lambda instance
+#
+# Each log file is claimed (by bucket, key and eTag) before it is processed, and marked done for
+# PROCESSED_TTL seconds once its alerts are published.  If processing fails the claim is released so
+# the retry processes it again; a claim that is never released (e.g. a timeout) lapses after
+# PROCESSED_LEASE seconds.
 
 
-import io
-import gzip
+import os
+import re
+import sys
 import json
+import sqlite3
+import argparse
+import datetime
+import time
+import zlib
+import codecs
+import threading
+import contextlib
+import collections
 import boto3
 import logging
 import botocore
 import botocore.exceptions
+from botocore.config import Config
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 logger = logging.getLogger()
 
@@ -61,32 +123,334 @@ logging.basicConfig(
     format='%(levelname)s:%(name)s:%(message)s',
     level=logging.INFO)
 
+# Size of the pieces in which a log file is downloaded and decompressed
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Alert in eventTime order (by sorting the matched records of each log file), rather than file order
+SORT_MATCHES = os.environ.get('SORT_MATCHES', 'true').lower() != 'false'
+
+# Start of the array of records in a CloudTrail log file, and the separators between records
+RECORDS_START = re.compile(r'"Records"\s*:\s*\[')
+RECORD_SEPARATOR = re.compile(r'[\s,]*')
+
+# Region to look up instances in when a record has no awsRegion
+DEFAULT_REGION = os.environ.get('AWS_REGION', 'us-west-2')
+
+# Shared by every client: enough pooled connections for concurrent calls, and retries with backoff
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get('MAX_POOL_CONNECTIONS', 25)),
+    connect_timeout=5,
+    read_timeout=30,
+    retries={'mode': 'standard', 'max_attempts': 5})
+
+# IDs of EC2 (and related) resources, picked out of records for the local index (--index)
+RESOURCE_ID = re.compile(r'^(i|vol|snap|sg|subnet|vpc|eni|ami|igw|rtb|acl|nat|eipalloc|lt)-[0-9a-f]{8,17}$')
+
+# Tables and indexes of the local index
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS log_files (
+    source TEXT PRIMARY KEY,
+    records INTEGER,
+    ingested TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    event_id TEXT UNIQUE,
+    event_time TEXT,
+    event_source TEXT,
+    event_name TEXT,
+    region TEXT,
+    account TEXT,
+    principal TEXT,
+    source_ip TEXT,
+    error_code TEXT,
+    log_file TEXT,
+    record TEXT
+);
+CREATE TABLE IF NOT EXISTS event_resources (
+    event INTEGER REFERENCES events(id),
+    resource TEXT
+);
+CREATE INDEX IF NOT EXISTS events_by_time ON events (event_time);
+CREATE INDEX IF NOT EXISTS events_by_name ON events (event_name, event_time);
+CREATE INDEX IF NOT EXISTS events_by_principal ON events (principal, event_time);
+CREATE INDEX IF NOT EXISTS resources_by_id ON event_resources (resource, event);
+"""
 
-def get_records(session, bucket, key):
+# CloudWatch namespace of the metrics each invocation logs in Embedded Metric Format.  They are logged
+# when running in Lambda, or when EMIT_METRICS is true; from the command line a summary table is printed.
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CloudTrailWatch')
+EMIT_METRICS = os.environ.get('EMIT_METRICS', str('AWS_LAMBDA_FUNCTION_NAME' in os.environ)).lower() == 'true'
+
+# Phases of the processing that are timed, and the counts kept, in the order they are reported
+PHASES = ('download', 'decompress', 'parse', 'match', 'enrich', 'publish')
+COUNTS = ('log_files', 'log_files_skipped', 'log_files_failed', 'bytes_downloaded', 'records_scanned', 'records_matched',
+          'alerts', 'alerts_failed', 'tag_cache_hits', 'tag_cache_misses')
+
+# Log files downloaded and parsed at once, when an event (e.g. a batch of SQS messages) has several
+LOG_FILE_WORKERS = int(os.environ.get('LOG_FILE_WORKERS', 8))
+
+# Most messages, and most bytes of messages, SNS PublishBatch takes in one call
+PUBLISH_BATCH_SIZE = 10
+PUBLISH_BATCH_BYTES = 256 * 1024
+
+# Instance tags are cached across warm invocations, for up to TAG_CACHE_TTL seconds
+TAG_CACHE_SIZE = int(os.environ.get('TAG_CACHE_SIZE', 10000))
+TAG_CACHE_TTL = int(os.environ.get('TAG_CACHE_TTL', 300))
+
+# Where log files are remembered as processed (see above), and for how long
+PROCESSED_STORE = os.environ.get('PROCESSED_STORE', '')
+PROCESSED_TTL = int(os.environ.get('PROCESSED_TTL', 24 * 60 * 60))
+PROCESSED_LEASE = int(os.environ.get('PROCESSED_LEASE', 15 * 60))
+
+# Most values DescribeInstances accepts in one filter
+DESCRIBE_BATCH_SIZE = 200
+
+RULES_FILE = os.environ.get(
+    'RULES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cloudtrail-watch-rules.json'))
+
+# Predicate operators a rule can use in "match", applied to each value found at the field's path
+PREDICATE_OPERATORS = {
+    'equals': lambda value, expected: value == expected,
+    'not_equals': lambda value, expected: value != expected,
+    'in': lambda value, expected: value in expected,
+    'not_in': lambda value, expected: value not in expected,
+    'prefix': lambda value, expected: isinstance(value, str) and value.startswith(expected),
+    'contains': lambda value, expected: isinstance(value, (str, list)) and expected in value,
+    'regex': lambda value, expected: isinstance(value, str) and expected.search(value) is not None,
+}
+
+
+class Metrics(object):
     """
-    Loads a CloudTrail log file, decompresses it, and extracts its records.
+    Seconds spent in each phase, and counts of what was processed, since the last reset (the start
+    of each invocation).  Phases are timed exclusively: e.g. the time parsing waits for the next
+    chunk to be downloaded and decompressed counts as download and decompress time, not parse time.
+    Each thread also keeps its own total of timed seconds, so that a phase which pulls on the others
+    can subtract them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.seconds = collections.Counter()
+            self.counts = collections.Counter()
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.seconds[phase] += seconds
+        self.thread.seconds = self.thread_seconds() + seconds
+
+    def thread_seconds(self):
+        """ Seconds timed so far by the current thread, in any phase """
+        return getattr(self.thread, 'seconds', 0.0)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def merge(self, seconds, counts):
+        """ Add the seconds and counts of another Metrics (e.g. from a worker process) """
+        with self.lock:
+            self.seconds.update(seconds)
+            self.counts.update(counts)
+
+    def emit(self):
+        """ Log the metrics as a single CloudWatch Embedded Metric Format line """
+        metrics = {f"{phase}_ms": round(self.seconds[phase] * 1000, 3) for phase in PHASES}
+        metrics.update({name: self.counts[name] for name in COUNTS})
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [
+                        {'Name': name, 'Unit': 'Milliseconds' if name.endswith('_ms') else
+                         'Bytes' if name.startswith('bytes') else 'Count'}
+                        for name in metrics
+                    ],
+                }],
+            },
+            'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local'),
+            **metrics,
+        }), flush=True)
+
+    def print_summary(self):
+        """ Print a table of the metrics, for the command line """
+        total = sum(self.seconds[phase] for phase in PHASES) or 1
+        print('Phase          Seconds    Share')
+        print('--------------------------------')
+        for phase in PHASES:
+            print(f"{phase:<12}{self.seconds[phase]:>10.3f}  {self.seconds[phase] / total:>7.1%}")
+        print('--------------------------------')
+        for name in COUNTS:
+            print(f"{name:<20}{self.counts[name]:>12}")
+
+
+METRICS = Metrics()
+
+
+def gunzip_chunks(chunks):
+    """
+    Generator that decompresses gzip data (possibly several concatenated gzip members)
+    as it arrives, a chunk at a time.
+
+    :param chunks: iterable of compressed bytes
+    :return: yields decompressed bytes
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        while chunk:
+            with METRICS.timer('decompress'):
+                data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            chunk = b''
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    with METRICS.timer('decompress'):
+        data = decompressor.flush()
+    if data:
+        yield data
+
+
+def parse_records(chunks):
+    """
+    Generator for the records of a CloudTrail log file ({"Records": [...]}), parsed one at
+    a time from the pieces of its text as they arrive, so that only one record (and one
+    piece of text) is held in memory at a time.
+
+    :param chunks: iterable of the (decompressed) bytes of the log file
+    :return: yields CloudTrail records, in file order
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = None     # within buffer, once the start of the Records array has been found
+
+    for chunk in chunks:
+        # timed from here, up to the next yield or the next chunk
+        start_time = time.perf_counter()
+        buffer = buffer[position or 0:] + text_decoder.decode(chunk)
+        if position is None:
+            start = RECORDS_START.search(buffer)
+            if not start:
+                continue
+            buffer = buffer[start.end():]
+        position = 0
+
+        while True:
+            position = RECORD_SEPARATOR.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if buffer[position] == ']':
+                METRICS.add_time('parse', time.perf_counter() - start_time)
+                return
+            try:
+                record, position_after = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # the rest of the record is in the next chunk
+                break
+            position = position_after
+            METRICS.add_time('parse', time.perf_counter() - start_time)
+            yield record
+            start_time = time.perf_counter()
+        METRICS.add_time('parse', time.perf_counter() - start_time)
+
+    raise ValueError('CloudTrail log file ended in the middle of its records')
+
+
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service, region=None):
+    """
+    Return the boto3 client for a service in a region, creating it the first time it is asked for.
+    Clients are kept at module level, so their connections, endpoints and credentials are reused
+    across warm Lambda invocations.
+    :param service: e.g. 'ec2'
+    :param region: region name, or None for the default region of the session
+    :return: boto3 client
+    """
+    global _session
+    client = _clients.get((service, region))
+    if client is None:
+        with _clients_lock:
+            client = _clients.get((service, region))
+            if client is None:
+                if _session is None:
+                    _session = boto3.session.Session()
+                client = _session.client(service, region_name=region, config=CLIENT_CONFIG)
+                _clients[(service, region)] = client
+    return client
+
+
+def stream_records(bucket, key):
+    """
+    Streams a CloudTrail log file from S3, decompressing and parsing it as it downloads.
+
+    A log file that can't be read raises the ClientError or BotoCoreError, for the caller to
+    report against the log file.
 
-    :param session: Boto3 session
     :param bucket: Bucket where log file is located
     :param key: Key to the log file object in the bucket
-    :return: list of CloudTrail records
+    :return: yields CloudTrail records, in file order
     """
 
-    try:
-        s3 = session.client('s3')
-        response = s3.get_object(Bucket=bucket, Key=key)
-    except botocore.exceptions.ClientError as e:
-        logger.error(e)
-        raise SystemExit
-    except botocore.exceptions.NoCredentialsError as e:
-        logger.error(e)
-        raise SystemExit
+    with METRICS.timer('download'):
+        response = get_client('s3').get_object(Bucket=bucket, Key=key)
+
+    yield from parse_records(gunzip_chunks(download_chunks(response['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE))))
+
+
+def download_chunks(chunks):
+    """ Generator that passes chunks of a download through, timing how long each takes to arrive """
+    chunks = iter(chunks)
+    while True:
+        with METRICS.timer('download'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        METRICS.count('bytes_downloaded', len(chunk))
+        yield chunk
+
 
-    with io.BytesIO(response['Body'].read()) as obj:
-        with gzip.GzipFile(fileobj=obj) as logfile:
-            records = json.load(logfile)['Records']
-            sorted_records = sorted(records, key=lambda r: r['eventTime'])
-            return sorted_records
+def read_local_records(path):
+    """
+    Streams a CloudTrail log file (.json.gz) from the local disk, the same way as stream_records
+
+    :param path: path to the log file
+    :return: yields CloudTrail records, in file order
+    """
+    with open(path, 'rb') as f:
+        yield from parse_records(gunzip_chunks(download_chunks(iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''))))
+
+
+def get_records(bucket, key):
+    """
+    Loads a CloudTrail log file, decompresses it, and extracts its records.
+
+    :param bucket: Bucket where log file is located
+    :param key: Key to the log file object in the bucket
+    :return: list of CloudTrail records, sorted by eventTime
+    """
+    return sorted(stream_records(bucket, key), key=lambda r: r['eventTime'])
 
 
 def get_log_file_location(event):
@@ -96,12 +460,30 @@ def get_log_file_location(event):
     (usually only one but this ensures we process them all).
 
     :param event: S3:ObjectCreated:Put notification event
-    :return: yields bucket and key names
+    :return: yields bucket and key names, and the eTag of the object (or None)
     """
-    for event_record in event['Records']:
+    # s3:TestEvent notifications have no Records
+    for event_record in event.get('Records', []):
         bucket = event_record['s3']['bucket']['name']
         key = event_record['s3']['object']['key']
-        yield bucket, key
+        yield bucket, key, event_record['s3']['object'].get('eTag')
+
+
+def get_s3_event(event_record):
+    """
+    Return the S3 notification carried by a record of the event sent to this function:
+    the record itself when S3 invokes the function directly, or the body of the message
+    when it comes from SQS (with the notification sent straight to SQS, or through SNS).
+
+    :param event_record: record of an S3 or SQS event
+    :return: S3:ObjectCreated:Put notification event
+    """
+    if event_record.get('eventSource') != 'aws:sqs':
+        return {'Records': [event_record]}
+    body = json.loads(event_record['body'])
+    if body.get('Type') == 'Notification' and 'Message' in body:
+        body = json.loads(body['Message'])
+    return body
 
 
 def parse_arn(arn):
@@ -146,89 +528,951 @@ def search_for_tag(list_of_dicts, search_tag):
         return None
 
 
-def get_ec2_tag(session, instance_id, tag_key):
+class TagCache(object):
+    """
+    LRU cache of the tags of EC2 instances, keyed by (region, instance ID) and kept at module
+    level so that it survives warm Lambda invocations.  Entries expire ttl seconds after they
+    are fetched, and once there are more than max_size the least recently used are evicted.
+    Instances that were not found are cached too, with no tags.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()    # (region, instance ID): (expiry time, tags)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the cached tags of an instance, or None if they are not cached (or have expired) """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                METRICS.count('tag_cache_misses')
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            METRICS.count('tag_cache_hits')
+            return entry[1]
+
+    def put(self, key, tags):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, tags)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def evict_expired(self):
+        """ Drop every expired entry """
+        with self.lock:
+            now = time.monotonic()
+            for key in [k for k, (expires, _) in self.entries.items() if expires <= now]:
+                del self.entries[key]
+
+    def invalidate(self, key=None):
+        """ Drop one instance from the cache, or every instance if no key is given """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+
+TAG_CACHE = TagCache(TAG_CACHE_SIZE, TAG_CACHE_TTL)
+
+
+def get_instance_tags(region, instance_ids):
+    """
+    Return the tags of each instance, from the cache where possible, and otherwise from
+    DescribeInstances calls of up to DESCRIBE_BATCH_SIZE instances each.  A failed call raises
+    the ClientError or BotoCoreError, for the caller to report against the log file.
+    :param region:  the region the instances are in
+    :param instance_ids:  the EC2 instance IDs
+    :return:  dictionary of each instance ID to a dictionary of its tags
+    """
+    tags = {}
+    missing = []
+    for instance_id in set(instance_ids):
+        cached = TAG_CACHE.get((region, instance_id))
+        if cached is None:
+            missing.append(instance_id)
+        else:
+            tags[instance_id] = cached
+
+    if not missing:
+        return tags
+
+    ec2 = get_client('ec2', region)
+    paginator = ec2.get_paginator('describe_instances')
+
+    for batch_start in range(0, len(missing), DESCRIBE_BATCH_SIZE):
+        batch = missing[batch_start:batch_start + DESCRIBE_BATCH_SIZE]
+        found = {instance_id: {} for instance_id in batch}
+        for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': batch}]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    found[instance['InstanceId']] = {t['Key']: t['Value'] for t in instance.get('Tags', [])}
+
+        for instance_id, instance_tags in found.items():
+            TAG_CACHE.put((region, instance_id), instance_tags)
+        tags.update(found)
+
+    return tags
+
+
+def get_ec2_tag(instance_id, tag_key, region=DEFAULT_REGION):
     """
     Search for an instance's tag, and return the value if exists
-    :param session:  the boto3 session object
     :param instance_id:  the EC2 instance ID
     :param tag_key:  the tag we are searching for
+    :param region:  the region the instance is in
     :return:  the value associated with tag_key
     """
-    ec2 = session.resource('ec2', region_name='us-west-2')
+    return get_instance_tags(region, [instance_id])[instance_id].get(tag_key)
+
+
+def compile_path(path):
+    """
+    Compile a dotted field path into a function that returns every value found at that path
+    in a record.  A "[]" suffix on a field visits each element of the list it holds, and
+    a numeric field indexes into a list.
+    :param path: e.g. "requestParameters.instancesSet.items[].instanceId"
+    :return: function of a record, returning a list of values (empty if the path is missing)
+    """
+    steps = []
+    for field in path.split('.'):
+        expand = field.endswith('[]')
+        steps.append((field[:-2] if expand else field, expand))
+
+    def extract(record):
+        values = [record]
+        for field, expand in steps:
+            found = []
+            for value in values:
+                if isinstance(value, dict) and field in value:
+                    value = value[field]
+                elif isinstance(value, list) and field.isdigit() and int(field) < len(value):
+                    value = value[int(field)]
+                else:
+                    continue
+                if expand and isinstance(value, list):
+                    found.extend(value)
+                elif value is not None:
+                    found.append(value)
+            values = found
+        return values
+
+    return extract
+
+
+def compile_predicate(predicate):
+    """
+    Compile a {"field": path, "op": op, "value": value} predicate into a function of a record
+    :param predicate: predicate from a rule's "match" list
+    :return: function of a record, returning True if the predicate holds
+    """
+    extract = compile_path(predicate['field'])
+    op = predicate.get('op', 'equals')
+    if op == 'exists':
+        return lambda record: bool(extract(record))
+    if op == 'absent':
+        return lambda record: not extract(record)
+    if op not in PREDICATE_OPERATORS:
+        raise ValueError(f"unknown op '{op}' for field {predicate['field']}")
+    test = PREDICATE_OPERATORS[op]
+    expected = predicate['value']
+    if op == 'regex':
+        expected = re.compile(expected)
+    elif op in ('in', 'not_in'):
+        expected = set(expected)
+    return lambda record: any(test(value, expected) for value in extract(record))
+
+
+class Rule(object):
+    """ A compiled watch rule: its predicates, resource extractor and alert target """
+
+    def __init__(self, definition):
+        self.name = definition['name']
+        self.title = definition.get('title', self.name)
+        self.predicates = [compile_predicate(p) for p in definition.get('match', [])]
+        self.resources = compile_path(definition['resources'])
+        self.resource_type = definition.get('resourceType')
+        self.alert_tag = definition.get('alert', {}).get('tag')
+        self.alert_topic = definition.get('alert', {}).get('topic')
+        if not (self.alert_tag or self.alert_topic):
+            raise ValueError("alert must have a tag and/or a topic")
+        if self.alert_tag and self.resource_type != 'instance':
+            raise ValueError("alert tags can only be looked up for resourceType instance")
+
+    def matches(self, record):
+        return all(predicate(record) for predicate in self.predicates)
+
+    def topic_arn(self, resource_id, region):
+        """
+        The SNS topic to alert about a resource: the topic in its alert tag if it has one,
+        otherwise the fixed topic of the rule (if any, and its environment variables are set)
+        """
+        if self.alert_tag:
+            topic_arn = get_ec2_tag(resource_id, self.alert_tag, region)
+            if topic_arn:
+                return topic_arn
+            logger.info(f"Tag '{self.alert_tag}' not found on instance {resource_id}")
+        if self.alert_topic:
+            topic_arn = os.path.expandvars(self.alert_topic)
+            if topic_arn and '$' not in topic_arn:
+                return topic_arn
+            logger.info(f"Rule {self.name} has no topic to alert ({self.alert_topic} is not set)")
+        return None
 
-    filters = [
-        {'Name': 'instance-id', 'Values': [instance_id]},
-        {'Name': 'tag-key', 'Values': [tag_key]}
-    ]
 
+def load_rules(path):
+    """
+    Load the rules file and compile it into an index of the rules for each (eventSource, eventName),
+    so that a record costs a single lookup plus the predicates of the rules for its event.
+    :param path: path to the rules file
+    :return: dictionary of (eventSource, eventName) to a list of Rules
+    """
     try:
-        instances = ec2.instances.filter(Filters=filters)
-    except botocore.exceptions.ClientError as e:
-        logger.error(e)
-        raise SystemExit
-    except botocore.exceptions.NoCredentialsError as e:
-        logger.error(e)
+        with open(path) as f:
+            definitions = json.load(f)['rules']
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Unable to load rules from {path}: {e}")
         raise SystemExit
 
-    if instances and len(list(instances)) == 1:
-        # There should only ever be one as we filter on instance ID
-        instance = list(instances)[0]
-        return search_for_tag(instance.tags, tag_key)
-    else:
+    index = {}
+    names = set()
+    for definition in definitions:
+        try:
+            rule = Rule(definition)
+            if rule.name in names:
+                raise ValueError(f"there is more than one rule named {rule.name}")
+            names.add(rule.name)
+            event_names = definition['eventName']
+            if isinstance(event_names, str):
+                event_names = [event_names]
+            for event_name in event_names:
+                index.setdefault((definition['eventSource'], event_name), []).append(rule)
+        except (KeyError, TypeError, ValueError, re.error) as e:
+            logger.error(f"Invalid rule {definition.get('name')} in {path}: {e!r}")
+            raise SystemExit
+    logger.info(f"Loaded {len(definitions)} rules for {len(index)} events from {path}")
+    return index
+
+
+# Compiled once per cold start
+RULE_INDEX = load_rules(RULES_FILE)
+
+
+# Every rule, by name
+RULES_BY_NAME = {rule.name: rule for rules in RULE_INDEX.values() for rule in rules}
+
+
+def match_records(records):
+    """
+    Keep the records that match a rule
+
+    :param records: iterable of CloudTrail records
+    :return: number of records, and a list of (record number, record, [(rule, resource IDs)]) for each matched record
+    """
+    # the time spent getting the records is timed by the other phases, and subtracted
+    start_time = time.perf_counter()
+    start_seconds = METRICS.thread_seconds()
+
+    matched = []
+    record_count = 0
+    for record_count, record in enumerate(records, start=1):
+        rules = RULE_INDEX.get((record.get('eventSource'), record.get('eventName')))
+        if rules:
+            hits = [(rule, rule.resources(record)) for rule in rules if rule.matches(record)]
+            if hits:
+                matched.append((record_count - 1, record, hits))
+
+    if SORT_MATCHES:
+        matched.sort(key=lambda m: m[1]['eventTime'])
+
+    METRICS.add_time('match', time.perf_counter() - start_time - (METRICS.thread_seconds() - start_seconds))
+    METRICS.count('records_scanned', record_count)
+    METRICS.count('records_matched', len(matched))
+    return record_count, matched
+
+
+def prefetch_tags(matched):
+    """
+    Look up the tags of every instance the matched records refer to, in as few calls as possible,
+    in the region of each record
+
+    :param matched: matched records, as returned by match_records
+    """
+    with METRICS.timer('enrich'):
+        _prefetch_tags(matched)
+
+
+def _prefetch_tags(matched):
+    instance_ids = {}
+    for _, record, hits in matched:
+        for rule, resource_ids in hits:
+            if rule.resource_type == 'instance':
+                instance_ids.setdefault(record.get('awsRegion', DEFAULT_REGION), set()).update(resource_ids)
+    for region, region_instance_ids in instance_ids.items():
+        get_instance_tags(region, region_instance_ids)
+    if instance_ids:
+        logger.info(f'Tags of {sum(len(ids) for ids in instance_ids.values())} instances looked up '
+                    f'(cache hits {TAG_CACHE.hits}, misses {TAG_CACHE.misses} since cold start)')
+
+
+class MemoryStore(object):
+    """
+    Log files claimed or processed, kept at module level so that they survive warm Lambda
+    invocations (but no more).  Each entry is the time its claim lapses, or its done mark expires.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def claim(self, log_file_id):
+        with self.lock:
+            now = time.time()
+            for expired in [k for k, expires in self.entries.items() if expires <= now]:
+                del self.entries[expired]
+            if log_file_id in self.entries:
+                return False
+            self.entries[log_file_id] = now + PROCESSED_LEASE
+            return True
+
+    def complete(self, log_file_id):
+        with self.lock:
+            self.entries[log_file_id] = time.time() + PROCESSED_TTL
+
+    def release(self, log_file_id):
+        with self.lock:
+            self.entries.pop(log_file_id, None)
+
+
+class SqliteStore(object):
+    """ Log files claimed or processed, in a local SQLite database """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS processed (id TEXT PRIMARY KEY, state TEXT, expires REAL)')
+        self.lock = threading.Lock()
+
+    def claim(self, log_file_id):
+        with self.lock:
+            now = time.time()
+            self.connection.execute('DELETE FROM processed WHERE expires <= ?', (now,))
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO processed (id, state, expires) VALUES (?, 'claimed', ?)",
+                (log_file_id, now + PROCESSED_LEASE))
+            return cursor.rowcount == 1
+
+    def complete(self, log_file_id):
+        with self.lock:
+            self.connection.execute("UPDATE processed SET state = 'done', expires = ? WHERE id = ?",
+                                    (time.time() + PROCESSED_TTL, log_file_id))
+
+    def release(self, log_file_id):
+        with self.lock:
+            self.connection.execute('DELETE FROM processed WHERE id = ?', (log_file_id,))
+
+
+class DynamoDBStore(object):
+    """
+    Log files claimed or processed, in a DynamoDB table shared by every Lambda instance.  A claim
+    is a conditional put, which only succeeds if there is no item for the log file, or its
+    expiry has passed (DynamoDB TTL deletes expired items, but only eventually).
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def claim(self, log_file_id):
+        now = int(time.time())
+        try:
+            get_client('dynamodb').put_item(
+                TableName=self.table,
+                Item={'id': {'S': log_file_id}, 'state': {'S': 'claimed'}, 'expires': {'N': str(now + PROCESSED_LEASE)}},
+                ConditionExpression='attribute_not_exists(id) OR expires <= :now',
+                ExpressionAttributeValues={':now': {'N': str(now)}})
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def complete(self, log_file_id):
+        get_client('dynamodb').update_item(
+            TableName=self.table,
+            Key={'id': {'S': log_file_id}},
+            UpdateExpression='SET #state = :done, expires = :expires',
+            ExpressionAttributeNames={'#state': 'state'},
+            ExpressionAttributeValues={':done': {'S': 'done'}, ':expires': {'N': str(int(time.time()) + PROCESSED_TTL)}})
+
+    def release(self, log_file_id):
+        get_client('dynamodb').delete_item(TableName=self.table, Key={'id': {'S': log_file_id}})
+
+
+def open_processed_store(spec):
+    """
+    Return the store of processed log files described by PROCESSED_STORE, or None if there is none
+
+    :param spec: "dynamodb:<table>", "sqlite:<path>", "memory" or ""
+    """
+    kind, _, location = spec.partition(':')
+    if not kind:
         return None
+    if kind == 'memory':
+        return MemoryStore()
+    if kind == 'sqlite' and location:
+        return SqliteStore(location)
+    if kind == 'dynamodb' and location:
+        return DynamoDBStore(location)
+    raise ValueError(f"PROCESSED_STORE must be dynamodb:<table>, sqlite:<path> or memory, not {spec!r}")
 
 
-def main(event=None):
+PROCESSED = open_processed_store(PROCESSED_STORE)
+
+
+def log_file_id(bucket, key, etag):
+    """ Identify a log file in the store of processed log files; a rewritten object gets a new eTag """
+    return f"{bucket}/{key}/{etag or ''}"
+
+
+def scan_log_file(bucket, key, etag=None):
+    """
+    Stream a CloudTrail log file, keep the records that match a rule, and look up the tags
+    of every instance they refer to.  A log file that another delivery of the notification
+    has claimed or processed is skipped, without being downloaded.
+
+    :param bucket: Bucket where log file is located
+    :param key: Key to the log file object in the bucket
+    :param etag: eTag of the log file, from the notification
+    :return: list of (record number, record, [(rule, resource IDs)]) for each matched record,
+             or None if the log file was skipped
+    """
+    if PROCESSED and not PROCESSED.claim(log_file_id(bucket, key, etag)):
+        logger.info(f'Skipping CloudTrail log file s3://{bucket}/{key}, which was already processed')
+        return None
+
+    try:
+        logger.info(f'Loading CloudTrail log file s3://{bucket}/{key}')
+        record_count, matched = match_records(stream_records(bucket, key))
+        logger.info(f'Number of records in log file s3://{bucket}/{key}: {record_count} ({len(matched)} matched)')
+        prefetch_tags(matched)
+    except Exception:
+        if PROCESSED:
+            PROCESSED.release(log_file_id(bucket, key, etag))
+        raise
+    return matched
+
+
+class Alert(object):
+    """
+    An alert to one SNS topic about one CloudTrail record, listing every resource of the record
+    that the topic is to hear about, so that e.g. a reboot of 50 instances is a single message.
+    The message is only rendered when it is published.
+    """
+
+    def __init__(self, rule, record, region):
+        self.rule = rule
+        self.record = record
+        self.region = region
+        self.resource_ids = []
+        self.message_ids = set()    # the SQS messages it came from, to retry if publishing fails
+
+    def render(self, event_json):
+        message = f"*** {self.rule.title} ***\n\n"
+        for resource_id in self.resource_ids:
+            if self.rule.resource_type == 'instance':
+                name_tag = get_ec2_tag(resource_id, 'Name', self.region)
+                message += f"Instance ID: {resource_id}\nName Tag: {name_tag}\n\n"
+            else:
+                message += f"Resource: {resource_id}\n\n"
+        message += f"*** CloudTrail Event ***\n\n{json.dumps(self.record, indent=4)}\n\n"
+        message += f"*** Lambda Triggering Event ***\n\n{event_json}\n\n"
+        if len(message.encode('utf-8')) > PUBLISH_BATCH_BYTES:
+            message = message.encode('utf-8')[:PUBLISH_BATCH_BYTES - 100].decode('utf-8', 'ignore')
+            message += '\n\n... (truncated)\n'
+        return message
+
+
+def collect_alerts(matched, alerts, message_id=None):
+    """
+    Add an alert for the matched records of a log file to the alerts of each SNS topic.  Alerts
+    about the same record (by eventID) for the same rule and topic are merged into one, which
+    also collapses a record delivered twice in the same invocation.
+
+    :param matched: matched records, as returned by scan_log_file
+    :param alerts: dictionary of SNS topic ARN to a dictionary of its alerts, added to
+    :param message_id: the SQS message the log file came in, if any
+    """
+    for record_number, record, hits in matched:
+        region = record.get('awsRegion', DEFAULT_REGION)
+
+        for rule, resource_ids in hits:
+            for item_number, resource_id in enumerate(resource_ids):
+                logger.info(f"Record {record_number}:{item_number} --> {rule.title}: {resource_id}")
+
+                sns_topic_arn = rule.topic_arn(resource_id, region)
+
+                if sns_topic_arn:
+                    alert_key = (rule.name, record.get('eventID') or id(record))
+                    topic_alerts = alerts.setdefault(sns_topic_arn, {})
+                    alert = topic_alerts.get(alert_key)
+                    if alert is None:
+                        alert = topic_alerts[alert_key] = Alert(rule, record, region)
+                    if resource_id not in alert.resource_ids:
+                        alert.resource_ids.append(resource_id)
+                    alert.message_ids.add(message_id)
+
+
+def publish_alerts(alerts, event):
+    """
+    Publish the alerts of each SNS topic, with PublishBatch calls of up to PUBLISH_BATCH_SIZE messages
+
+    :param alerts: dictionary of SNS topic ARN to a dictionary of its alerts
+    :param event: the event sent to this function, to include in the messages
+    :return: set of the SQS message IDs (None without SQS) whose alerts could not be published
+    """
+    failed_messages = set()
+    if not alerts:
+        return failed_messages
+
+    with METRICS.timer('publish'):
+        _publish_alerts(alerts, event, failed_messages)
+    return failed_messages
+
+
+def _publish_alerts(alerts, event, failed_messages):
 
     # used in the SNS message
     event_json = json.dumps(event, indent=4)
 
-    # Create a Boto3 session that can be used to construct clients
-    session = boto3.session.Session()
+    for sns_topic_arn, topic_alerts in alerts.items():
+        logger.info(f"Alerting to SNS Topic: {sns_topic_arn} ({len(topic_alerts)} messages)")
+        # extract the region from the arn and setup sns client
+        arn_components = parse_arn(sns_topic_arn)
+        sns = get_client('sns', arn_components['region'])
 
-    # Get the S3 bucket and key for each log file contained in the event
-    for bucket, key in get_log_file_location(event):
-        # Load the CloudTrail log file and extract its records
-        logger.info(f'Loading CloudTrail log file s3://{bucket}/{key}')
-        records = get_records(session, bucket, key)
-        logger.info(f'Number of records in log file: {len(records)}')
-
-        # Process the CloudTrail records
-        for record_number, record in enumerate(records):
-
-            # save the CloutTrail event as json to be used in the SNS message
-            record_json = json.dumps(record, indent=4)
-
-            if 'eventName' in record.keys():
-
-                # TODO: We are only looking for RebootInstances events at this time, but should generalize this
-                # TODO: to be more useful for watching for any type of event
-                if record['eventName'] == 'RebootInstances':
-                    param_items = record['requestParameters']['instancesSet']['items']
-                    for item_number, item in enumerate(param_items):
-                        instance_id = item['instanceId']
-                        logger.info(f"Record {record_number}:{item_number} --> Instance {instance_id} was rebooted")
-
-                        sns_topic_arn = get_ec2_tag(session, instance_id, 'alert_topic_arn')
-
-                        if sns_topic_arn:
-                            logger.info(f"Alerting to SNS Topic: {sns_topic_arn}")
-                            # extract the region from the arn and setup sns client
-                            arn_components = parse_arn(sns_topic_arn)
-                            sns_region = arn_components['region']
-                            name_tag = get_ec2_tag(session, instance_id, 'Name')
-                            sns_message = f"*** EC2 Instance Rebooted ***\n\nInstance ID: {instance_id}\n"
-                            sns_message += f"Name Tag: {name_tag}\n\n"
-                            sns_message += f"*** CloudTrail Event ***\n\n{record_json}\n\n"
-                            sns_message += f"*** Lambda Triggering Event ***\n\n{event_json}\n\n"
-                            sns = session.client('sns', region_name=sns_region)
-                            sns.publish(TopicArn=sns_topic_arn, Message=sns_message)
-                        else:
-                            logger.info(f"Tag 'alert_topic_arn' not found on instance {instance_id}")
+        batches = [[]]
+        batch_bytes = 0
+        for alert in topic_alerts.values():
+            try:
+                message = alert.render(event_json)
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                # the Name tags of its instances could not be looked up
+                logger.error(f"Unable to render an alert to {sns_topic_arn}: {e!r}")
+                failed_messages.update(alert.message_ids)
+                METRICS.count('alerts_failed')
+                continue
+            message_bytes = len(message.encode('utf-8'))
+            if len(batches[-1]) == PUBLISH_BATCH_SIZE or batch_bytes + message_bytes > PUBLISH_BATCH_BYTES:
+                batches.append([])
+                batch_bytes = 0
+            batches[-1].append((alert, message))
+            batch_bytes += message_bytes
+
+        for batch in batches:
+            if not batch:
+                continue
+            entries = [{'Id': str(n), 'Message': message} for n, (_, message) in enumerate(batch)]
+            try:
+                response = sns.publish_batch(TopicArn=sns_topic_arn, PublishBatchRequestEntries=entries)
+                failed = response.get('Failed', [])
+            except botocore.exceptions.ClientError as e:
+                failed = [{'Id': entry['Id'], 'Code': e.response['Error']['Code'], 'Message': str(e)}
+                          for entry in entries]
+            for failure in failed:
+                alert, _ = batch[int(failure['Id'])]
+                logger.error(f"Unable to publish to {sns_topic_arn}: {failure['Code']} {failure.get('Message', '')}")
+                failed_messages.update(alert.message_ids)
+            METRICS.count('alerts', len(batch) - len(failed))
+            METRICS.count('alerts_failed', len(failed))
+
+
+def main(event=None):
+    """
+    Process every log file in an S3 notification event, or in a batch of SQS messages carrying
+    S3 notifications.  Up to LOG_FILE_WORKERS log files are downloaded and parsed at once, while
+    the alerts are published in the order of the log files in the event.
+
+    :param event: S3 or SQS event
+    :return: for an SQS event, the messages that failed, as a partial batch response
+    """
+
+    METRICS.reset()
+    TAG_CACHE.evict_expired()
+
+    # a test or scheduled invocation may have no records
+    event_records = event.get('Records', [])
+    is_sqs_event = any(r.get('eventSource') == 'aws:sqs' for r in event_records)
+    failed_messages = []
+    first_error = None
+    alerts = {}
+    processed = []  # (message ID, log file ID) of the log files this invocation claimed and processed
+
+    # Get the S3 bucket and key for each log file contained in the event, along with the SQS message they came in
+    log_files = []
+    for event_record in event_records:
+        message_id = event_record.get('messageId')
+        try:
+            log_files.extend((message_id, bucket, key, etag)
+                             for bucket, key, etag in get_log_file_location(get_s3_event(event_record)))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Unable to read the S3 notification in message {message_id}: {e!r}")
+            failed_messages.append(message_id)
+            first_error = first_error or e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(LOG_FILE_WORKERS, len(log_files)))) as executor:
+        # read ahead by at most twice the number of workers, so matched records don't pile up
+        pending = iter(log_files)
+        in_flight = collections.deque()
+        for message_id, bucket, key, etag in pending:
+            in_flight.append((message_id, bucket, key, etag, executor.submit(scan_log_file, bucket, key, etag)))
+            if len(in_flight) >= 2 * LOG_FILE_WORKERS:
+                break
+
+        while in_flight:
+            message_id, bucket, key, etag, future = in_flight.popleft()
+            for next_message_id, next_bucket, next_key, next_etag in pending:
+                in_flight.append((next_message_id, next_bucket, next_key, next_etag,
+                                  executor.submit(scan_log_file, next_bucket, next_key, next_etag)))
+                break
+
+            METRICS.count('log_files')
+            try:
+                matched = future.result()
+                if matched is None:
+                    METRICS.count('log_files_skipped')
+                    continue
+                processed.append((message_id, log_file_id(bucket, key, etag)))
+                if message_id not in failed_messages:
+                    with METRICS.timer('publish'):
+                        collect_alerts(matched, alerts, message_id)
+            except Exception as e:
+                METRICS.count('log_files_failed')
+                logger.error(f"Failed to process s3://{bucket}/{key}: {e!r}")
+                if message_id not in failed_messages:
+                    failed_messages.append(message_id)
+                first_error = first_error or e
+
+    if is_sqs_event:
+        # alerts that only failed messages asked for are dropped, as they will be raised when the messages are retried
+        alerts = {
+            topic: {k: a for k, a in topic_alerts.items() if a.message_ids - set(failed_messages)}
+            for topic, topic_alerts in alerts.items()
+        }
+        alerts = {topic: topic_alerts for topic, topic_alerts in alerts.items() if topic_alerts}
+
+    for message_id in publish_alerts(alerts, event):
+        if message_id not in failed_messages:
+            failed_messages.append(message_id)
+        first_error = first_error or RuntimeError('Unable to publish every alert')
+
+    if PROCESSED:
+        # log files of the messages that failed are released, so that they are processed again when retried
+        for message_id, processed_id in processed:
+            try:
+                if message_id in failed_messages:
+                    PROCESSED.release(processed_id)
+                else:
+                    PROCESSED.complete(processed_id)
+            except Exception as e:
+                logger.error(f"Unable to update the processed log file store for {processed_id}: {e!r}")
+
+    if EMIT_METRICS:
+        METRICS.emit()
+
+    if is_sqs_event:
+        # only the failed messages go back to the queue to be retried
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_messages]}
+    if first_error:
+        raise first_error
 
 
 def lambda_handler(event, context):
-    main(event=event)
+    return main(event=event)
+
+
+def list_prefixes(bucket, prefix):
+    """
+    Generator for the names of the "folders" directly under a prefix of a bucket
+
+    :param bucket: S3 bucket
+    :param prefix: key prefix, ending in /
+    :return: yields the folder names, without the prefix or trailing /
+    """
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            yield common_prefix['Prefix'][len(prefix):].rstrip('/')
+
+
+def list_log_files(bucket, prefix, accounts, regions, start, end):
+    """
+    Generator for the keys of the CloudTrail log files delivered for the given accounts and
+    regions (all of them found in the bucket, if not given) from the start date to the end date.
+
+    :param bucket: S3 bucket the trail delivers to
+    :param prefix: key prefix up to the account IDs, e.g. "AWSLogs/" or "AWSLogs/o-exampleorgid/"
+    :param accounts: list of account IDs, or None
+    :param regions: list of region names, or None
+    :param start: first date (datetime.date)
+    :param end: last date (datetime.date)
+    :return: yields object keys
+    """
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    for account in accounts or list(list_prefixes(bucket, prefix)):
+        trail_prefix = f"{prefix}{account}/CloudTrail/"
+        for region in regions or list(list_prefixes(bucket, trail_prefix)):
+            day = start
+            while day <= end:
+                for page in paginator.paginate(Bucket=bucket, Prefix=f"{trail_prefix}{region}/{day:%Y/%m/%d}/"):
+                    for obj in page.get('Contents', []):
+                        if obj['Key'].endswith('.json.gz'):
+                            yield obj['Key']
+                day += datetime.timedelta(days=1)
+
+
+def reset_clients():
+    """ Forget the clients of the parent process, which a forked worker process must not share """
+    global _session, _clients
+    _session = None
+    _clients = {}
+
+
+def backfill_log_file(source):
+    """
+    Match the records of one log file, for a backfill run in a worker process.  Rules are given
+    by name, as compiled rules can't be sent back to the parent process.
+
+    :param source: (bucket, key) of a log file in S3, or the path of a local one
+    :return: source, number of records, matched records (as match_records, with rule names), error (or None),
+             and the seconds and counts of the metrics
+    """
+    METRICS.reset()
+    try:
+        records = read_local_records(source) if isinstance(source, str) else stream_records(*source)
+        record_count, matched = match_records(records)
+    except Exception as e:
+        return source, 0, [], repr(e), (METRICS.seconds, METRICS.counts)
+    matched = [(n, record, [(rule.name, ids) for rule, ids in hits]) for n, record, hits in matched]
+    return source, record_count, matched, None, (METRICS.seconds, METRICS.counts)
+
+
+def print_match(record, rule, resource_ids):
+    """ Print a line of the backfill report for each resource of a matched record """
+    principal = record.get('userIdentity', {}).get('arn') or record.get('userIdentity', {}).get('principalId')
+    for resource_id in resource_ids:
+        print(f"{record.get('eventTime', ''):<22}{record.get('eventName', ''):<32}{rule.name:<32}"
+              f"{record.get('awsRegion', ''):<16}{resource_id:<24}{principal}")
+
+
+def backfill(sources, processes, report_only, start=None, end=None, description=None):
+    """
+    Run the rules over historical log files, in a pool of worker processes, and print every match.
+    Unless report_only, alert the SNS topics of the matches as the Lambda function would.
+
+    :param sources: iterable of (bucket, key) of log files in S3, or paths of local ones
+    :param processes: number of worker processes
+    :param report_only: print the matches without alerting
+    :param start: if given, only records from this date (datetime.date) on
+    :param end: if given, only records up to this date
+    :param description: included in the alerts in place of the Lambda triggering event
+    """
+    start_time = datetime.datetime.now()
+    file_count = record_count = match_count = 0
+    errors = []
+    alerts = {}
+    METRICS.reset()
+
+    print('Event Time            Event Name                      Rule                            '
+          'Region          Resource                Principal')
+    print('-' * 160)
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=reset_clients) as executor:
+        for source, records, matched, error, metrics in executor.map(backfill_log_file, sources, chunksize=4):
+            file_count += 1
+            record_count += records
+            METRICS.merge(*metrics)
+            METRICS.count('log_files')
+            if error:
+                METRICS.count('log_files_failed')
+                errors.append((source, error))
+                continue
+
+            kept = []
+            for record_number, record, hits in matched:
+                event_date = record.get('eventTime', '')[:10]
+                if (start and event_date < start.isoformat()) or (end and event_date > end.isoformat()):
+                    continue
+                hits = [(RULES_BY_NAME[name], resource_ids) for name, resource_ids in hits]
+                for rule, resource_ids in hits:
+                    print_match(record, rule, resource_ids)
+                kept.append((record_number, record, hits))
+            match_count += len(kept)
+
+            if kept and not report_only:
+                try:
+                    prefetch_tags(kept)
+                    with METRICS.timer('publish'):
+                        collect_alerts(kept, alerts)
+                except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+                    # the matches are reported, but the log file is counted as failed as it could not be alerted on
+                    METRICS.count('log_files_failed')
+                    errors.append((source, repr(e)))
+
+    print('-' * 160)
+    elapsed = (datetime.datetime.now() - start_time).total_seconds()
+    print(f"Scanned {file_count} log files ({record_count} records) in {elapsed:.1f} seconds: {match_count} matched")
+
+    for source, error in errors:
+        print(f"ERROR: {source}: {error}", file=sys.stderr)
+
+    if alerts:
+        failed = publish_alerts(alerts, description)
+        print(f"Published alerts to {len(alerts)} topics" + (" (some failed, see the errors above)" if failed else ''))
+
+    print()
+    METRICS.print_summary()
+
+
+def find_resources(value, found):
+    """
+    Add the resource IDs and ARNs found anywhere in a record (or part of one) to a set.
+    The resource part of each ARN is added as well, so that e.g. a role can be found by name.
+
+    :param value: record, or any value within one
+    :param found: set of resource IDs, added to
+    """
+    if isinstance(value, dict):
+        for item in value.values():
+            find_resources(item, found)
+    elif isinstance(value, list):
+        for item in value:
+            find_resources(item, found)
+    elif isinstance(value, str):
+        if value.startswith('arn:') and value.count(':') >= 5:
+            found.add(value)
+            found.add(parse_arn(value)['resource'])
+        elif RESOURCE_ID.match(value):
+            found.add(value)
+
+
+def read_log_file(source):
+    """ Read the records of a log file in S3 ((bucket, key)) or on the local disk (path), sorted by eventTime """
+    if isinstance(source, str):
+        return sorted(read_local_records(source), key=lambda r: r['eventTime'])
+    return get_records(*source)
+
+
+def ingest(index_file, sources, workers):
+    """
+    Add every record of the log files that are not in the index yet to it
+
+    :param index_file: path of the SQLite index
+    :param sources: list of (bucket, key) of log files in S3, or paths of local ones
+    :param workers: number of log files to download and parse at once
+    """
+    db = sqlite3.connect(index_file)
+    db.executescript(INDEX_SCHEMA)
+
+    names = [source if isinstance(source, str) else f"s3://{source[0]}/{source[1]}" for source in sources]
+    ingested = {row[0] for row in db.execute('SELECT source FROM log_files')}
+    pending = [(name, source) for name, source in zip(names, sources) if name not in ingested]
+    print(f"{len(pending)} new log files to add to {index_file} ({len(sources) - len(pending)} already there)")
+
+    start_time = datetime.datetime.now()
+    event_count = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # in slices, so that the records of only so many log files are held in memory at once
+        for slice_start in range(0, len(pending), 4 * workers):
+            names_and_sources = pending[slice_start:slice_start + 4 * workers]
+            futures = [(name, executor.submit(read_log_file, source)) for name, source in names_and_sources]
+            for name, future in futures:
+                try:
+                    records = future.result()
+                except Exception as e:
+                    print(f"ERROR: {name}: {e!r}", file=sys.stderr)
+                    continue
+                with db:
+                    for record in records:
+                        identity = record.get('userIdentity', {})
+                        cursor = db.execute(
+                            'INSERT OR IGNORE INTO events (event_id, event_time, event_source, event_name, region, '
+                            'account, principal, source_ip, error_code, log_file, record) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (record.get('eventID'), record.get('eventTime'), record.get('eventSource'),
+                             record.get('eventName'), record.get('awsRegion'), record.get('recipientAccountId'),
+                             identity.get('arn') or identity.get('principalId'), record.get('sourceIPAddress'),
+                             record.get('errorCode'), name, json.dumps(record, separators=(',', ':'))))
+                        if not cursor.rowcount:
+                            continue
+                        resources = set()
+                        find_resources(record.get('requestParameters'), resources)
+                        find_resources(record.get('responseElements'), resources)
+                        find_resources(record.get('resources'), resources)
+                        db.executemany('INSERT INTO event_resources (event, resource) VALUES (?, ?)',
+                                       [(cursor.lastrowid, resource) for resource in resources])
+                        event_count += 1
+                    db.execute('INSERT INTO log_files (source, records, ingested) VALUES (?, ?, ?)',
+                               (name, len(records), datetime.datetime.now().isoformat()))
+
+    elapsed = (datetime.datetime.now() - start_time).total_seconds()
+    print(f"Added {event_count} events in {elapsed:.1f} seconds")
+    db.close()
+
+
+def query_index(index_file, resource, event_name, principal, start, end, limit):
+    """
+    Print the events in the index that match every filter given, oldest first
+
+    :param index_file: path of the SQLite index
+    :param resource: resource ID or ARN, or None
+    :param event_name: event name, or None
+    :param principal: principal ARN, or None
+    :param start: first date (datetime.date)
+    :param end: last date, or None
+    :param limit: most events to print
+    """
+    if not os.path.exists(index_file):
+        print(f"\nIndex {index_file} does not exist.  Create it with --index and --bucket or --local-dir.\n")
+        raise SystemExit
+
+    conditions = ['e.event_time >= ?']
+    parameters = [start.isoformat()]
+    if end:
+        conditions.append('e.event_time < ?')
+        parameters.append((end + datetime.timedelta(days=1)).isoformat())
+    if resource:
+        conditions.append('e.id IN (SELECT event FROM event_resources WHERE resource = ?)')
+        parameters.append(resource)
+    if event_name:
+        conditions.append('e.event_name = ?')
+        parameters.append(event_name)
+    if principal:
+        conditions.append('e.principal = ?')
+        parameters.append(principal)
+
+    db = sqlite3.connect(index_file)
+    start_time = datetime.datetime.now()
+    rows = db.execute(
+        'SELECT e.event_time, e.event_name, e.region, e.principal, e.error_code, '
+        '(SELECT group_concat(resource, \' \') FROM event_resources WHERE event = e.id) '
+        f'FROM events e WHERE {" AND ".join(conditions)} ORDER BY e.event_time LIMIT ?',
+        parameters + [limit]).fetchall()
+    elapsed = (datetime.datetime.now() - start_time).total_seconds()
+
+    print('Event Time            Event Name                      Region          Principal / Error / Resources')
+    print('-' * 160)
+    for event_time, name, region, event_principal, error_code, resources in rows:
+        print(f"{event_time:<22}{name:<32}{region or '':<16}{event_principal}"
+              f"{'  ' + error_code if error_code else ''}  {resources or ''}")
+    print('-' * 160)
+    print(f"{len(rows)} events in {elapsed * 1000:.0f} ms" + (f" (--limit {limit} reached)" if len(rows) == limit else ''))
+    db.close()
 
 
 if __name__ == '__main__':
@@ -272,5 +1516,180 @@ if __name__ == '__main__':
         ]
     }
 
-    main(event=test_event)
+    help_description = '''
+Without options, process the test event below as the Lambda function would.
+
+With --bucket or --local-dir, backfill: run the rules over CloudTrail log files that have already
+been delivered, to find past occurrences of the events they watch for.  Matches are printed, and
+alerted as the Lambda function would alert them, unless --report-only is given.
+
+With --index as well, load the log files into a local SQLite index instead, which --query searches.
+
+---------------------------------------------------------------------------
+Examples:
+
+    Report every match in December 2018, for all accounts and regions in the bucket:
+
+        python cloudtrail-watch-for-reboot.py --bucket my-trail-bucket --start 2018-12-01 --end 2018-12-31 \\
+            --report-only
+
+    Only one account and two regions, from an organization trail:
+
+        python cloudtrail-watch-for-reboot.py --bucket my-trail-bucket --prefix AWSLogs/o-exampleorgid/ \\
+            --accounts 305170822333 --regions us-west-2,us-east-1 --start 2018-12-01 --report-only
+
+    Log files downloaded to a local directory:
+
+        python cloudtrail-watch-for-reboot.py --local-dir ./trail-logs --report-only
+
+    Add the log files delivered since the last run to a local index, then search it for every event
+    touching an instance in the last 30 days:
+
+        python cloudtrail-watch-for-reboot.py --bucket my-trail-bucket --start 2018-12-01 --index trail.db
+        python cloudtrail-watch-for-reboot.py --index trail.db --query --resource i-0abc1234def567890
+
+---------------------------------------------------------------------------
+
+'''
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description=help_description)
+
+    parser.add_argument(
+        '--bucket',
+        help='S3 bucket the trail delivers its log files to')
+
+    parser.add_argument(
+        '--prefix',
+        default='AWSLogs/',
+        help='Key prefix up to the account IDs (default AWSLogs/).\n'
+             'Include the trail\'s own prefix, or the organization ID of an organization trail,\n'
+             'e.g. myprefix/AWSLogs/ or AWSLogs/o-exampleorgid/\n')
+
+    parser.add_argument(
+        '--accounts',
+        help='Comma separated account IDs (default every account in the bucket)')
+
+    parser.add_argument(
+        '--regions',
+        help='Comma separated regions (default every region in the bucket)')
+
+    parser.add_argument(
+        '--start',
+        type=datetime.date.fromisoformat,
+        help='First day to process, YYYY-MM-DD (required with --bucket)')
+
+    parser.add_argument(
+        '--end',
+        type=datetime.date.fromisoformat,
+        help='Last day to process, YYYY-MM-DD (default today)')
+
+    parser.add_argument(
+        '--local-dir',
+        help='Process the .json.gz log files in this directory (and below) instead of S3')
+
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of worker processes (default the number of CPUs)')
+
+    parser.add_argument(
+        '--report-only',
+        action='store_true',
+        help='Print the matches without alerting')
+
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='Log every log file as it is processed')
+
+    parser.add_argument(
+        '--index',
+        help='SQLite file to keep a local index of the log files in.\n'
+             'With --bucket or --local-dir, add every record of the log files that are not\n'
+             'in the index yet, instead of backfilling.  With --query, search it.\n')
+
+    parser.add_argument(
+        '--query',
+        action='store_true',
+        help='Print the events in --index, filtered by --resource, --event-name and --principal,\n'
+             'from --start (default --days ago) to --end\n')
+
+    parser.add_argument(
+        '--resource',
+        help='With --query, only events that refer to this resource ID or ARN')
+
+    parser.add_argument(
+        '--event-name',
+        help='With --query, only events with this name')
+
+    parser.add_argument(
+        '--principal',
+        help='With --query, only events by this principal (user or role ARN)')
+
+    parser.add_argument(
+        '--days',
+        type=int,
+        default=30,
+        help='With --query and no --start, only events from the last this many days (default 30)')
+
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=1000,
+        help='With --query, most events to print (default 1000)')
+
+    args = parser.parse_args()
+
+    if args.query:
+        if not args.index:
+            print("\nMust specify --index with --query.  Use --help to show full usage info.\n")
+            raise SystemExit
+        query_index(args.index, args.resource, args.event_name, args.principal,
+                    args.start or datetime.date.today() - datetime.timedelta(days=args.days), args.end, args.limit)
+        raise SystemExit
+
+    if not (args.bucket or args.local_dir):
+        main(event=test_event)
+        print()
+        METRICS.print_summary()
+        raise SystemExit
+
+    if args.bucket and args.local_dir:
+        print("\n--bucket and --local-dir can not be used together.\n")
+        raise SystemExit
+
+    if args.bucket and not args.start:
+        print("\nMust specify --start with --bucket.  Use --help to show full usage info.\n")
+        raise SystemExit
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    end = args.end or datetime.date.today()
+
+    if args.local_dir:
+        log_files = sorted(
+            os.path.join(directory, name)
+            for directory, _, names in os.walk(args.local_dir)
+            for name in names if name.endswith('.json.gz'))
+        description = {'backfill': {'local_dir': args.local_dir}}
+    else:
+        prefix = args.prefix if args.prefix.endswith('/') or not args.prefix else args.prefix + '/'
+        accounts = args.accounts.split(',') if args.accounts else None
+        regions = args.regions.split(',') if args.regions else None
+        log_files = [
+            (args.bucket, key)
+            for key in list_log_files(args.bucket, prefix, accounts, regions, args.start, end)
+        ]
+        description = {'backfill': {'bucket': args.bucket, 'prefix': prefix, 'accounts': accounts,
+                                    'regions': regions, 'start': str(args.start), 'end': str(end)}}
+
+    try:
+        if args.index:
+            ingest(args.index, log_files, args.processes)
+        else:
+            backfill(log_files, args.processes, args.report_only, args.start, args.end, description)
+    except KeyboardInterrupt:
+        print("\nInterrupted.\n")
 
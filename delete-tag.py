@@ -2,8 +2,13 @@
 
 import sys
 import argparse
-import boto3
+import threading
 import botocore.exceptions
+from botocore.config import Config
+from tag_targets import ThreadOutput, get_sessions, get_targets, run_targets, print_target_summary
+
+# Throttled calls are left to botocore, with more patience than its default of 3 attempts
+BOTO_CONFIG = Config(retries={'mode': 'standard', 'total_max_attempts': 10})
 
 #
 # Helper Functions
@@ -31,6 +36,11 @@ If --profile is not specified, the AWS_PROFILE environment variable will be used
 
 If --region is not specified, it will default to "us-east-1"
 
+To run across several regions, give --regions (a comma separated list, or "all" for every region enabled in
+the account).  To run across several accounts, give --accounts; the --role-name role is assumed in each of
+them using the --profile credentials.  Up to --max-targets account/region targets are run at once, and their
+output is printed one target after another, followed by a summary of each target.
+
 ---------------------------------------------------------------------------
 Examples:
 
@@ -50,6 +60,10 @@ Examples:
 
         ./delete-tag.py --delete --tag AppName --dry-run
 
+    Report on the tag in every enabled region of two accounts, assuming the same role in each:
+
+        ./delete-tag.py --report --tag AppName --regions all --accounts 111111111111,222222222222 --role-name TagAdmin
+
 ---------------------------------------------------------------------------
 
 '''
@@ -64,6 +78,25 @@ parser.add_argument(
     '--region',
     help='AWS Region ID (e.g. us-east-1)')
 
+parser.add_argument(
+    '--regions',
+    help='Comma separated AWS Region IDs, or "all" for every region enabled in the account (overrides --region)')
+
+parser.add_argument(
+    '--accounts',
+    help='Comma separated AWS account IDs, to assume --role-name in')
+
+parser.add_argument(
+    '--role-name',
+    default='OrganizationAccountAccessRole',
+    help='Role assumed in each of --accounts (default OrganizationAccountAccessRole)')
+
+parser.add_argument(
+    '--max-targets',
+    type=int,
+    default=8,
+    help='Number of account/region targets run at once (default 8)')
+
 parser.add_argument(
     '--instance',
     help='Limit to specific Instance ID (e.g. i-00248125391db0f4b)')
@@ -107,6 +140,11 @@ report = args.report
 delete = args.delete
 tag_key = args.tag
 
+regions = args.regions
+accounts = args.accounts.split(',') if args.accounts else None
+role_name = args.role_name
+max_targets = args.max_targets
+
 if report and delete:
     print(f"\nCannot specify both --report and --delete at the same time!  Use --help to show full usage info.\n")
     raise SystemExit
@@ -119,14 +157,17 @@ if not tag_key:
     print(f"\nMust specify --tag <tag key> to report on or delete!  Use --help to show full usage info.\n")
     raise SystemExit
 
+if max_targets < 1:
+    print(f"\n--max-targets must be at least 1.  Use --help to show full usage info.\n")
+    raise SystemExit
+
 if not region:
     region = 'us-east-1'
 
 try:
     # If profile is specified, we use it rather than AWS_PROFILE
-    if profile:
-        boto3.setup_default_session(profile_name=profile)
-    ec2_client = boto3.client('ec2', region_name=region)
+    sessions = get_sessions(profile, accounts, role_name, max_targets, 'delete-tag')
+    targets = get_targets(sessions, regions, region, BOTO_CONFIG)
 except botocore.exceptions.ProfileNotFound as e:
     print(f"ERROR: Profile {profile} not found in your ~/.aws/credentials file")
     raise SystemExit
@@ -150,10 +191,17 @@ volume_filters.append({'Name': 'tag-key', 'Values': [tag_key]})
 snapshot_filters.append({'Name': 'tag-key', 'Values': [tag_key]})
 
 
-try:
+# Set on Ctrl-C, so that running targets make no more calls
+stop = threading.Event()
+
+
+def delete_tag(ec2_client):
+    """ Print the tag of each instance, volume and snapshot that has it, deleting it unless this is a report or dry run """
     response = ec2_client.describe_instances(Filters=instance_filters)
     for reservation in response['Reservations']:
         for instance in reservation['Instances']:
+            if stop.is_set():
+                return
             instance_id = instance['InstanceId']
             print(f"{instance_id}: ", end='')
             print("{} = {}".format(tag_key, search_for_tag(instance['Tags'], tag_key)), end='')
@@ -174,6 +222,8 @@ try:
 
     volume_response = ec2_client.describe_volumes(Filters=volume_filters)
     for volume in volume_response['Volumes']:
+        if stop.is_set():
+            return
         volume_id = volume['VolumeId']
         print(f"{volume_id}: ", end='')
         print("{} = {}".format(tag_key, search_for_tag(volume['Tags'], tag_key)), end='')
@@ -194,6 +244,8 @@ try:
 
     snapshot_response = ec2_client.describe_snapshots(Filters=snapshot_filters, OwnerIds=['self'])
     for snapshot in snapshot_response['Snapshots']:
+        if stop.is_set():
+            return
         snapshot_id = snapshot['SnapshotId']
         print(f"{snapshot_id}: ", end='')
         print("{} = {}".format(tag_key, search_for_tag(snapshot['Tags'], tag_key)), end='')
@@ -212,11 +264,30 @@ try:
         else:
             print("")
 
+
+sys.stdout = ThreadOutput(sys.stdout)
+results = []
+
+
+def print_target(target, result):
+    """ Print the output of a target, as soon as it and the targets before it are done """
+    account, target_region, _ = target
+    output, _, _, error = result
+    results.append(result)
+    if len(targets) > 1:
+        print(f"\n=== Account {account or 'default'}, Region {target_region} ===\n")
+    print(output, end='')
+    if error:
+        print(f"\nERROR: {error}")
+
+
+try:
+    run_targets(targets, delete_tag, max_targets, stop, print_target)
+
 except KeyboardInterrupt:
     print(f"\nHow wewd!")
     raise SystemExit
 
-except botocore.exceptions.ClientError as e:
-    print(f"\nERROR: {e}")
-    raise SystemExit
-
+if len(targets) > 1:
+    print()
+    print_target_summary(targets, results)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+#
+# Export a DynamoDB table to CSV, in a format that dynamodb-import.py can read back in
+#
+
+from __future__ import print_function
+import argparse
+import base64
+import boto3
+import botocore.exceptions
+import csv
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from tqdm import tqdm
+
+logger = logging.getLogger()
+
+# Number of items read up front to decide on the csv columns, when --columns is not given
+SAMPLE_ITEMS = 1000
+
+# Scan throttling is left to botocore, with more patience than its default of 3 attempts
+BOTO_CONFIG = Config(retries={'mode': 'standard', 'total_max_attempts': 10})
+
+# The --types column type that dynamodb-import.py needs to read each attribute type back
+IMPORT_TYPES = {
+    'S': 'S',
+    'B': 'S',
+    'NULL': 'S',
+    'N': 'N',
+    'BOOL': 'BOOL',
+    'M': 'JSON',
+    'L': 'JSON',
+    'SS': 'JSON',
+    'NS': 'JSON',
+    'BS': 'JSON',
+}
+
+# Attribute types that dynamodb-import.py can't give back, and what they are imported as instead
+LOSSY_TYPES = {
+    'B': 'a base64 string (S)',
+    'NULL': 'a missing attribute',
+    'SS': 'a list (L)',
+    'NS': 'a list (L)',
+    'BS': 'a list of base64 strings (L)',
+}
+
+#
+# Helper Functions
+#
+
+def get_key_names(table_description):
+    """ Return the names of the table's key attributes, partition key first """
+    key_schema = sorted(table_description['KeySchema'], key=lambda k: k['KeyType'] != 'HASH')
+    return [k['AttributeName'] for k in key_schema]
+
+
+def sample_columns(client, table_name, key_names):
+    """ Return the key attributes, followed by every other attribute found in the first items of the table """
+    columns = list(key_names)
+    response = client.scan(TableName=table_name, Limit=SAMPLE_ITEMS)
+    for item in response['Items']:
+        for name in item:
+            if name not in columns:
+                columns.append(name)
+    return columns
+
+
+def to_json(value):
+    """
+    Convert a DynamoDB attribute value into compact JSON text.  Numbers are written with all
+    their digits (DynamoDB keeps up to 38), which a float would round, so the text is built here
+    rather than by json.dumps.
+    """
+    (type_code, data), = value.items()
+    if type_code == 'N':
+        return to_number(data)
+    if type_code == 'NS':
+        return '[' + ','.join(to_number(n) for n in data) + ']'
+    if type_code == 'M':
+        return '{' + ','.join(f"{json.dumps(k)}:{to_json(v)}" for k, v in data.items()) + '}'
+    if type_code == 'L':
+        return '[' + ','.join(to_json(v) for v in data) + ']'
+    if type_code == 'B':
+        return json.dumps(base64.b64encode(data).decode('ascii'))
+    if type_code == 'BS':
+        return json.dumps([base64.b64encode(b).decode('ascii') for b in data], separators=(',', ':'))
+    if type_code == 'SS':
+        return json.dumps(list(data), separators=(',', ':'))
+    if type_code == 'NULL':
+        return 'null'
+    # S and BOOL
+    return json.dumps(data)
+
+
+def to_number(text):
+    # Decimal keeps every digit, and its text is always a valid JSON number (e.g. ".5" becomes "0.5")
+    return str(Decimal(text))
+
+
+def to_cell(value):
+    """ Convert a DynamoDB attribute value into csv cell text, the way dynamodb-import.py expects it """
+    (type_code, data), = value.items()
+    if type_code in ('S', 'N'):
+        return data
+    if type_code == 'BOOL':
+        return 'true' if data else 'false'
+    if type_code == 'NULL':
+        return ''
+    if type_code == 'B':
+        return base64.b64encode(data).decode('ascii')
+    return to_json(value)
+
+
+class ReadThrottle(object):
+    """
+    Token bucket shared by all scan workers, which paces reads to --max-rcu.  Scan only reports
+    the RCU a page cost after reading it, so the cost is paid afterwards, and a worker that
+    overdraws the bucket waits until it is refilled before reading its next page.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def spend(self, units):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - units
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        time.sleep(wait)
+
+
+def scan_segment(profile, region, table_name, segment, total_segments, pages, throttle, stop):
+    """
+    Scan one segment of the table and put each page of items on the pages queue, followed by
+    None when the segment is done.  The queue is bounded, so a worker that gets ahead of the
+    csv writer blocks instead of holding more pages in memory.  A failed segment sets stop, so
+    the others end at their next page rather than scanning the rest of the table.
+    """
+    scan_args = {
+        'TableName': table_name,
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'ReturnConsumedCapacity': 'TOTAL',
+    }
+
+    try:
+        session = boto3.session.Session(profile_name=profile, region_name=region)
+        client = session.client('dynamodb', config=BOTO_CONFIG)
+        while not stop.is_set():
+            response = client.scan(**scan_args)
+            pages.put(response['Items'])
+            if throttle:
+                throttle.spend(response['ConsumedCapacity']['CapacityUnits'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        pages.put(None)
+
+
+#
+# Main
+#
+
+help_description = '''
+Export a DynamoDB Table to CSV using a parallel Scan.  The key attributes are the first columns, so the
+file can be imported again with dynamodb-import.py.
+
+Numbers, booleans, maps and lists are written so that dynamodb-import.py can read them back with
+--types; the --types value to use is printed at the end of the export.  Other types do not survive the
+round trip: binary (B) values come back as base64 strings, sets (SS, NS and BS) as lists, and NULL
+values are left out.  A warning is printed for each column that has any of them.
+
+If --profile is not specified, the AWS_PROFILE environment variable will be used.
+
+If --region is not specified, the AWS_DEFAULT_REGION may be used
+
+See Also:  https://boto3.amazonaws.com/v1/documentation/api/latest/guide/configuration.html
+
+---------------------------------------------------------------------------
+Examples:
+
+    Export table foo to bar.csv, scanning 8 segments in parallel:
+
+        ./dynamodb-export.py --table foo --csv bar.csv --segments 8
+
+    Leave read capacity for other users of the table by capping the export at 500 RCU:
+
+        ./dynamodb-export.py --table foo --csv bar.csv --segments 8 --max-rcu 500
+
+    Export only some attributes:
+
+        ./dynamodb-export.py --table foo --csv bar.csv --columns id,name,age
+
+---------------------------------------------------------------------------
+
+'''
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description=help_description)
+
+parser.add_argument(
+    '--profile',
+    help='AWS Profile to use from ~/.aws/credentials or ~/.aws/config')
+
+parser.add_argument(
+    '--region',
+    help='AWS Region ID (e.g. us-east-1)')
+
+parser.add_argument(
+    '--table',
+    help='Name of DynamoDB Table to export')
+
+parser.add_argument(
+    '--csv',
+    help='CSV file to write ("-" for standard output)')
+
+parser.add_argument(
+    '--columns',
+    help='Comma separated attribute names to export.\n'
+         'By default the key attributes plus every attribute found in the first %d items.\n'
+         'Attributes that are not columns are left out (and counted at the end).\n' % SAMPLE_ITEMS)
+
+parser.add_argument(
+    '--segments',
+    type=int,
+    default=4,
+    help='Number of parallel Scan segments, each scanned by its own worker (default 4)')
+
+parser.add_argument(
+    '--max-pages-in-flight',
+    type=int,
+    help='Most pages of items (up to 1MB each) held in memory waiting to be written\n'
+         '(default twice --segments)')
+
+parser.add_argument(
+    '--max-rcu',
+    type=int,
+    help='Never read faster than this many RCU per second')
+
+args = parser.parse_args()
+
+profile = args.profile
+region = args.region
+
+dynamodb_table = args.table
+csv_file = args.csv
+segments = args.segments
+max_pages_in_flight = args.max_pages_in_flight or 2 * segments
+max_rcu = args.max_rcu
+
+if not csv_file:
+    print("\nMust specify --csv parameter.  Use --help to show full usage info.\n")
+    raise SystemExit
+
+if not dynamodb_table:
+    print("\nMust specify --table parameter.  Use --help to show full usage info.\n")
+    raise SystemExit
+
+if segments < 1 or max_pages_in_flight < 1:
+    print("\n--segments and --max-pages-in-flight must be at least 1.  Use --help to show full usage info.\n")
+    raise SystemExit
+
+if max_rcu is not None and max_rcu < 1:
+    print("\n--max-rcu must be at least 1.  Use --help to show full usage info.\n")
+    raise SystemExit
+
+try:
+    session = boto3.session.Session(profile_name=profile, region_name=region)
+    client = session.client('dynamodb', config=BOTO_CONFIG)
+    table_description = client.describe_table(TableName=dynamodb_table)['Table']
+    key_names = get_key_names(table_description)
+
+    if args.columns:
+        columns = key_names + [name.strip() for name in args.columns.split(',') if name.strip() not in key_names]
+    else:
+        columns = sample_columns(client, dynamodb_table, key_names)
+except botocore.exceptions.ProfileNotFound:
+    print(f"ERROR: Profile {profile} not found in your ~/.aws/credentials file")
+    raise SystemExit
+except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+    print(f"\nERROR: {e}\n")
+    raise SystemExit
+
+if any(name != name.lower() for name in columns):
+    print("WARNING: dynamodb-import.py lower cases column names, so attributes with capitals will be renamed on import")
+
+column_set = set(columns)
+# attribute types seen in each column, used to suggest --types for the import
+column_types = {name: set() for name in columns}
+dropped_attributes = {}
+
+throttle = ReadThrottle(max_rcu) if max_rcu else None
+pages = queue.Queue(maxsize=max_pages_in_flight)
+stop = threading.Event()
+
+output = sys.stdout if csv_file == '-' else open(csv_file, 'w', newline='')
+writer = csv.writer(output, lineterminator='\n')
+writer.writerow(columns)
+
+start_time = time.time()
+total_rows = 0
+
+with ThreadPoolExecutor(max_workers=segments) as executor:
+    futures = [
+        executor.submit(scan_segment, profile, region, dynamodb_table, segment, segments, pages, throttle, stop)
+        for segment in range(segments)
+    ]
+
+    running = segments
+    try:
+        with tqdm(unit=' rows', file=sys.stderr) as progress:
+            while running:
+                items = pages.get()
+                if items is None:
+                    running -= 1
+                    continue
+                for item in items:
+                    row = []
+                    for name in columns:
+                        value = item.get(name)
+                        if value is None:
+                            row.append('')
+                        else:
+                            column_types[name].add(next(iter(value)))
+                            row.append(to_cell(value))
+                    if not column_set.issuperset(item):
+                        for name in item.keys() - column_set:
+                            dropped_attributes[name] = dropped_attributes.get(name, 0) + 1
+                    writer.writerow(row)
+                progress.update(len(items))
+                total_rows += len(items)
+    finally:
+        # let the workers finish, whether or not we got to the end
+        stop.set()
+        while running:
+            if pages.get() is None:
+                running -= 1
+        if output is not sys.stdout:
+            output.close()
+
+    try:
+        for future in futures:
+            future.result()
+    except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+        print(f"\nERROR: {e}\n")
+        raise SystemExit
+
+elapsed = time.time() - start_time
+print(f"Exported {total_rows} rows in {elapsed:.1f} seconds ({total_rows / max(elapsed, 0.001):.0f} rows/sec)",
+      file=sys.stderr)
+
+for name, count in sorted(dropped_attributes.items()):
+    print(f"WARNING: attribute '{name}' is not a column and was left out of {count} rows", file=sys.stderr)
+
+import_types = []
+for name in columns:
+    types = {IMPORT_TYPES.get(type_code, 'S') for type_code in column_types[name]}
+    if len(types) == 1 and types != {'S'}:
+        import_types.append(f"{name.lower()}={types.pop()}")
+    elif len(types) > 1:
+        print(f"WARNING: column '{name}' has values of more than one type: {', '.join(sorted(column_types[name]))}",
+              file=sys.stderr)
+    for type_code in sorted(column_types[name] & LOSSY_TYPES.keys()):
+        print(f"WARNING: {type_code} values of column '{name}' will be imported as {LOSSY_TYPES[type_code]}",
+              file=sys.stderr)
+
+if import_types:
+    print(f"To import this file again, use:  --types {','.join(import_types)}", file=sys.stderr)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+#
+# Benchmark dynamodb-import.py offline, against a stubbed (or moto backed) DynamoDB
+#
+
+from __future__ import print_function
+import argparse
+import contextlib
+import csv
+import gzip
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import resource
+import runpy
+import shlex
+import statistics
+import string
+import sys
+import tempfile
+import time
+from botocore.awsrequest import AWSResponse
+from botocore.handlers import BUILTIN_HANDLERS
+
+IMPORTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dynamodb-import.py')
+
+TABLE_NAME = 'benchmark'
+KEY_NAME = 'id'
+
+# Prefix of the X-Amz-Target header on DynamoDB requests, ahead of the operation name
+TARGET_PREFIX = 'DynamoDB_20120810.'
+
+# Options that the benchmark sets itself, so they can't be passed through --import-args
+RESERVED_IMPORT_ARGS = ('--table', '--csv', '--profile', '--region')
+
+#
+# Helper Functions
+#
+
+def generate_csv(path, rows, columns, value_size, empty_cells, compression, seed):
+    """ Write a csv file of `rows` unique keys plus `columns` random string columns """
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits
+    opener = gzip.open if compression == 'gzip' else open
+    with opener(path, 'wt', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow([KEY_NAME] + [f"col{n}" for n in range(columns)])
+        for row_number in range(rows):
+            row = [f"key-{row_number}"]
+            for _ in range(columns):
+                if rng.random() < empty_cells:
+                    row.append('')
+                else:
+                    row.append(''.join(rng.choices(alphabet, k=value_size)))
+            writer.writerow(row)
+
+
+class RawBody(object):
+    """ The raw stream of a stubbed response, which is all AWSResponse needs of it """
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class ApiCounter(object):
+    """
+    botocore before-send handler that counts the calls and request bytes of each DynamoDB
+    operation, and the items put by BatchWriteItem.  With stub set, it also answers the requests
+    itself, so they never leave the process: the table is on-demand with a single string key,
+    every write succeeds and every BatchGetItem finds nothing.
+    """
+
+    def __init__(self, stub):
+        self.stub = stub
+        self.calls = {}
+        self.bytes_sent = {}
+        self.items_written = 0
+
+    def __call__(self, request, **kwargs):
+        target = request.headers.get('X-Amz-Target', b'')
+        if isinstance(target, bytes):
+            target = target.decode('ascii')
+        if not target.startswith(TARGET_PREFIX):
+            return None
+        operation = target[len(TARGET_PREFIX):]
+        body = request.body or b''
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        self.bytes_sent[operation] = self.bytes_sent.get(operation, 0) + len(body)
+        if operation == 'BatchWriteItem':
+            self.items_written += body.count(b'"PutRequest"')
+        if not self.stub:
+            return None
+        return AWSResponse(request.url, 200, {}, RawBody(json.dumps(self.respond(operation, body)).encode('utf-8')))
+
+    def respond(self, operation, body):
+        if operation == 'DescribeTable':
+            return {'Table': {
+                'TableName': TABLE_NAME,
+                'KeySchema': [{'AttributeName': KEY_NAME, 'KeyType': 'HASH'}],
+                'AttributeDefinitions': [{'AttributeName': KEY_NAME, 'AttributeType': 'S'}],
+                'BillingModeSummary': {'BillingMode': 'PAY_PER_REQUEST'},
+            }}
+        if operation == 'BatchWriteItem':
+            return {'UnprocessedItems': {}}
+        if operation == 'BatchGetItem':
+            return {'Responses': {TABLE_NAME: []}, 'UnprocessedKeys': {}}
+        raise ValueError(f"The stubbed DynamoDB does not support {operation}")
+
+
+def run_import(csv_file, backend, import_args, verbose, results):
+    """ Run dynamodb-import.py once, in this (child) process, and put its numbers on the results queue """
+    os.environ['AWS_ACCESS_KEY_ID'] = 'benchmark'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'benchmark'
+    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+    os.environ.pop('AWS_PROFILE', None)
+
+    counter = ApiCounter(stub=backend == 'stub')
+    # ahead of moto's own before-send handler, which would otherwise answer first
+    BUILTIN_HANDLERS.insert(0, ('before-send', counter))
+
+    with contextlib.ExitStack() as stack:
+        if backend == 'moto':
+            import boto3
+            from moto import mock_aws
+            stack.enter_context(mock_aws())
+            boto3.client('dynamodb').create_table(
+                TableName=TABLE_NAME,
+                KeySchema=[{'AttributeName': KEY_NAME, 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': KEY_NAME, 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST')
+            counter.calls.clear()
+            counter.bytes_sent.clear()
+            counter.items_written = 0
+        if not verbose:
+            devnull = stack.enter_context(open(os.devnull, 'w'))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+            stack.enter_context(contextlib.redirect_stderr(devnull))
+
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        sys.argv = [IMPORTER, '--table', TABLE_NAME, '--csv', csv_file] + import_args
+        start_time = time.perf_counter()
+        try:
+            runpy.run_path(IMPORTER, run_name='__main__')
+        except SystemExit:
+            # the importer only exits early (with a bare raise SystemExit) when something is wrong
+            raise SystemExit(1)
+        elapsed = time.perf_counter() - start_time
+
+    results.put({
+        'seconds': elapsed,
+        'calls': counter.calls,
+        'bytes_sent': counter.bytes_sent,
+        'items_written': counter.items_written,
+        'baseline_rss': baseline_rss,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+
+def benchmark(csv_file, backend, import_args, verbose):
+    """ Run one import in a fresh process, so each run's peak RSS is its own """
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=run_import, args=(csv_file, backend, import_args, verbose, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        print(f"\nThe import failed (exit code {process.exitcode}).  Use --verbose to see its output.\n")
+        raise SystemExit
+    run = results.get()
+    if not run['calls'].get('BatchWriteItem') or not run['items_written']:
+        print(f"\nThe import wrote nothing ({run['calls'].get('BatchWriteItem', 0)} BatchWriteItem calls, "
+              f"{run['items_written']} items).  Use --verbose to see its output.\n")
+        raise SystemExit
+    return run
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+
+
+def print_report(runs, rows):
+    """ Print a line per run, followed by the median rows/sec """
+    print('Run  Seconds   Rows/sec  BatchWriteItem   Bytes sent   Peak RSS (over baseline)')
+    print('---------------------------------------------------------------------------------')
+    for number, run in enumerate(runs, start=1):
+        # ru_maxrss is in kilobytes on Linux
+        print(f"{number:>3}  {run['seconds']:>7.2f}  {rows / run['seconds']:>9.0f}  "
+              f"{run['calls'].get('BatchWriteItem', 0):>14}  "
+              f"{format_bytes(run['bytes_sent'].get('BatchWriteItem', 0)):>11}  "
+              f"{format_bytes(run['peak_rss'] * 1024):>9} "
+              f"({format_bytes((run['peak_rss'] - run['baseline_rss']) * 1024)})")
+    print('---------------------------------------------------------------------------------')
+    print(f"Median: {rows / statistics.median(run['seconds'] for run in runs):.0f} rows/sec")
+
+    other_calls = {}
+    for run in runs:
+        for operation, count in run['calls'].items():
+            if operation != 'BatchWriteItem':
+                other_calls[operation] = other_calls.get(operation, 0) + count
+    if other_calls:
+        calls = ', '.join(f"{operation} {count / len(runs):.0f}" for operation, count in sorted(other_calls.items()))
+        print(f"Other calls per run: {calls}")
+
+
+#
+# Main
+#
+
+help_description = '''
+Benchmark dynamodb-import.py without touching AWS.  A synthetic csv file is generated, then imported
+--repeat times, each in a fresh process, into a stubbed DynamoDB that answers every request in memory
+(or into moto, with --backend moto).  Reports rows/sec, BatchWriteItem calls, request bytes and peak RSS
+for each run, so that changes to the import loop can be compared by number.
+
+The stub does almost no work per request, so its numbers are dominated by the importer itself.
+moto stores and validates every item, which is slower, but exercises the real response handling.
+
+---------------------------------------------------------------------------
+Examples:
+
+    Import 100,000 rows of 10 columns, 3 times:
+
+        ./dynamodb-import-benchmark.py --rows 100000 --columns 10
+
+    Larger values with half the cells empty, read through gzip with 4 workers:
+
+        ./dynamodb-import-benchmark.py --value-size 200 --empty-cells 0.5 --compression gzip \\
+            --import-args '--workers 4'
+
+    Keep the generated file to compare against later runs:
+
+        ./dynamodb-import-benchmark.py --rows 1000000 --keep bench.csv
+
+---------------------------------------------------------------------------
+
+'''
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description=help_description)
+
+parser.add_argument(
+    '--rows',
+    type=int,
+    default=100000,
+    help='Number of rows to generate (default 100000)')
+
+parser.add_argument(
+    '--columns',
+    type=int,
+    default=10,
+    help='Number of columns to generate, besides the key (default 10)')
+
+parser.add_argument(
+    '--value-size',
+    type=int,
+    default=32,
+    help='Length of each generated value, in characters (default 32)')
+
+parser.add_argument(
+    '--empty-cells',
+    type=float,
+    default=0.1,
+    help='Fraction of the cells (other than the key) left empty, from 0 to 1 (default 0.1)')
+
+parser.add_argument(
+    '--compression',
+    choices=['none', 'gzip'],
+    default='none',
+    help='Compress the generated file, to benchmark reading compressed input (default none)')
+
+parser.add_argument(
+    '--seed',
+    type=int,
+    default=0,
+    help='Random seed for the generated values (default 0)')
+
+parser.add_argument(
+    '--csv',
+    help='Import this csv file instead of generating one.\n'
+         'It must have an "id" column, which is used as the key.\n')
+
+parser.add_argument(
+    '--keep',
+    help='Save the generated csv file to this path, instead of deleting it at the end')
+
+parser.add_argument(
+    '--backend',
+    choices=['stub', 'moto'],
+    default='stub',
+    help='DynamoDB stand-in to import into (default stub)')
+
+parser.add_argument(
+    '--repeat',
+    type=int,
+    default=3,
+    help='Number of times to run the import (default 3)')
+
+parser.add_argument(
+    '--import-args',
+    default='',
+    help='Further options to pass to dynamodb-import.py, e.g. \'--workers 4 --types col0=N\'')
+
+parser.add_argument(
+    '--verbose',
+    action='store_true',
+    help='Show the output of dynamodb-import.py')
+
+args = parser.parse_args()
+
+import_args = shlex.split(args.import_args)
+
+if any(arg.split('=')[0] in RESERVED_IMPORT_ARGS for arg in import_args):
+    print(f"\n{', '.join(RESERVED_IMPORT_ARGS)} are set by the benchmark, so can not be in --import-args.\n")
+    raise SystemExit
+
+if args.rows < 1 or args.columns < 0 or args.value_size < 0 or args.repeat < 1:
+    print("\n--rows and --repeat must be at least 1, --columns and --value-size at least 0.\n")
+    raise SystemExit
+
+if not 0 <= args.empty_cells <= 1:
+    print("\n--empty-cells must be between 0 and 1.\n")
+    raise SystemExit
+
+if args.backend == 'moto':
+    if importlib.util.find_spec('moto') is None:
+        print("\n--backend moto needs the moto package (pip install moto)\n")
+        raise SystemExit
+
+temporary_dir = None
+if args.csv:
+    csv_file = args.csv
+    opener = gzip.open if csv_file.endswith('.gz') else open
+    with opener(csv_file, 'rt', newline='') as f:
+        rows = sum(1 for _ in csv.reader(f)) - 1
+    print(f"Importing {csv_file} ({rows} rows) into {args.backend}, {args.repeat} times")
+else:
+    if args.keep:
+        csv_file = args.keep
+    else:
+        temporary_dir = tempfile.TemporaryDirectory()
+        csv_file = os.path.join(temporary_dir.name, 'benchmark.csv' + ('.gz' if args.compression == 'gzip' else ''))
+    rows = args.rows
+    print(f"Generating {rows} rows of {args.columns} columns ({args.value_size} characters, "
+          f"{args.empty_cells:.0%} empty)")
+    generate_csv(csv_file, rows, args.columns, args.value_size, args.empty_cells, args.compression, args.seed)
+    print(f"Importing {format_bytes(os.path.getsize(csv_file))} into {args.backend}, {args.repeat} times")
+
+try:
+    runs = [benchmark(csv_file, args.backend, import_args, args.verbose) for _ in range(args.repeat)]
+except KeyboardInterrupt:
+    print("\nInterrupted.\n")
+    raise SystemExit
+finally:
+    if temporary_dir:
+        temporary_dir.cleanup()
+
+print()
+print_report(runs, rows)
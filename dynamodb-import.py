@@ -1,23 +1,1111 @@
 #!/usr/bin/env python
 #
-# Import CSV data to a DynamoDB table that uses a simple partition key
+# Import CSV data to a DynamoDB table that uses a simple partition key, or a partition key and sort key
 #
 
 from __future__ import print_function
 import argparse
 import boto3
+import bz2
+import contextlib
 import csv
+import glob
+import gzip
+import hashlib
+import io
+import itertools
+import json
 import logging
+import math
+import mmap
+import operator
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import botocore.exceptions
+from botocore.config import Config
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from decimal import Decimal, InvalidOperation
 from tqdm import tqdm
 
+try:
+    import zstandard    # only needed to read .zst input
+except ImportError:
+    zstandard = None
+
 logger = logging.getLogger()
 
+# tqdm's counter is not safe to bump from several worker threads at once
+progress_lock = threading.Lock()
+
+# How many rows a worker parses before it reports progress
+PROGRESS_INTERVAL = 1000
+
+# BatchWriteItem accepts at most 25 put requests per call
+BATCH_SIZE = 25
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
+
+# How many groups of BATCH_GET_SIZE rows a worker reads ahead while their --delta table lookups run
+LOOKUP_READ_AHEAD = 4
+
+# Last column of a --save-digests file, after one column per key attribute
+DIGEST_COLUMN = '#digest'
+
+# On-demand tables have no provisioned WCU; this is the default per-table write quota
+ON_DEMAND_WCU = 40000
+
+# Error codes that mean "slow down", rather than "this request is bad"
+THROTTLING_ERRORS = (
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+)
+
+# Error codes of a passing fault on DynamoDB's side, which a request is retried after without
+# slowing down, as they say nothing about the capacity of the table
+SERVER_ERRORS = (
+    'InternalServerError',
+    'ServiceUnavailable',
+)
+
+# Network errors that a request is retried after, as botocore's own retries are turned off (see BOTO_CONFIG)
+TRANSPORT_ERRORS = (
+    botocore.exceptions.ConnectionError,
+    botocore.exceptions.HTTPClientError,
+)
+
+# Give up on a batch after this many consecutive throttled attempts
+MAX_RETRIES = 10
+
+# Minimum number of seconds between writes of the --checkpoint file
+CHECKPOINT_INTERVAL = 10
+
+# Above this many (estimated) rows, duplicate keys are found with a Bloom filter and a second pass
+# instead of a dictionary of every key, to keep memory bounded
+EXACT_DEDUP_ROWS = 2000000
+
+# False positive rate of the Bloom filter, which sets its size (about 14 bits per row at 0.1%)
+BLOOM_ERROR_RATE = 0.001
+
+# Size of the chunks read from a compressed file or standard input, and how many are read ahead
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_READ_AHEAD = 8
+
+# Leading bytes of each compressed format that can be read
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bzip2'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+# Assumed ratio of csv to compressed size, for estimating the rows in a compressed file
+COMPRESSION_RATIO_GUESS = 6
+
+# Number of hashed partition key groups that --schedule-window interleaves rows across
+SCHEDULE_BUCKETS = 256
+
+# Cell values accepted by the BOOL column type (compared in lower case)
+TRUE_VALUES = ('true', 't', 'yes', 'y', '1')
+FALSE_VALUES = ('false', 'f', 'no', 'n', '0')
+
+# The write pacing does its own backoff, so botocore must not hide throttling behind silent retries;
+# network errors (TRANSPORT_ERRORS) are retried by the same loops
+BOTO_CONFIG = Config(retries={'mode': 'standard', 'total_max_attempts': 1})
+
+#
+# Helper Functions
+#
+
+def expand_paths(patterns):
+    """ Expand the --csv arguments, which may be paths, glob patterns, or "-" for standard input """
+    paths = []
+    for pattern in patterns:
+        if pattern == '-' or os.path.exists(pattern):
+            paths.append(pattern)
+            continue
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print(f"\nNo csv file matches {pattern}\n")
+            raise SystemExit
+        paths.extend(matches)
+    if paths.count('-') > 1:
+        print("\nStandard input (-) can only be given once.\n")
+        raise SystemExit
+    return paths
+
+
+def detect_compression(raw):
+    """ Return the compression format of a binary stream that supports peek(), or None if it is plain """
+    magic = raw.peek(4)[:4]
+    for prefix, compression in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def decompress(raw, compression):
+    """ Wrap a binary stream so that reading it decompresses on the fly """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw)
+    if compression == 'bzip2':
+        return bz2.BZ2File(raw)
+    if compression == 'zstd':
+        if zstandard is None:
+            print("\nReading zstd compressed input needs the zstandard package (pip install zstandard)\n")
+            raise SystemExit
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True))
+    return raw
+
+
+class CsvSource(object):
+    """
+    One csv input: a plain file, a gzip, bzip2 or zstd compressed file, or standard input ("-").
+    Plain files are read through mmap and can be split into segments; the others are streams,
+    which are decompressed on the fly and read from start to end by a single worker.  Offsets
+    in a compressed file count decompressed bytes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if path == '-':
+            self.size = None
+            self.compression = detect_compression(sys.stdin.buffer)
+            # standard input can only be read once, so the stream is kept open for StreamLines
+            self.stdin_stream = decompress(sys.stdin.buffer, self.compression)
+            header_line = self.stdin_stream.readline()
+        else:
+            self.size = os.path.getsize(path)
+            with open(path, 'rb') as raw:
+                self.compression = detect_compression(raw)
+                header_line = decompress(raw, self.compression).readline()
+        self.data_start = len(header_line)
+        self.header = next(csv.reader([header_line.decode('utf-8')]), [])
+
+    @property
+    def seekable(self):
+        """ True if the source is a plain file, which can be split into byte-range segments """
+        return self.path != '-' and not self.compression
+
+    @contextlib.contextmanager
+    def open_stream(self):
+        """ Open the source as a (decompressed) binary stream, positioned at the first data row """
+        if self.path == '-':
+            yield self.stdin_stream
+            return
+        with open(self.path, 'rb') as raw:
+            stream = decompress(raw, self.compression)
+            stream.readline()
+            yield stream
+
+    def lines(self, start, end=None):
+        """ Return an iterator over the lines that begin within byte range [start, end) """
+        if self.seekable:
+            return SegmentLines(self.path, start, self.size if end is None else end)
+        return StreamLines(self, start, end)
+
+    def line_number(self, offset):
+        """ Return the number of the line that (decompressed) byte offset is on, counting the header as line 1 """
+        if offset < self.data_start:
+            return 1
+        newlines = 0
+        if offset > self.data_start:
+            # only ever needed for an error message, so the data is simply read up to the offset
+            with self.open_stream() as stream:
+                to_read = offset - self.data_start
+                while to_read > 0:
+                    chunk = stream.read(min(to_read, STREAM_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    newlines += chunk.count(b'\n')
+                    to_read -= len(chunk)
+        return 2 + newlines
+
+
+def estimate_rows(sources, sample_lines=1000):
+    """ Estimate the number of data rows in the sources from the average length of their first lines """
+    rows = 0
+    for source in sources:
+        with source.open_stream() as stream:
+            sample = [len(line) for _, line in zip(range(sample_lines), stream)]
+        if sample:
+            data_size = source.size - source.data_start
+            if not source.seekable:
+                data_size = source.size * COMPRESSION_RATIO_GUESS
+            rows += int(data_size / (sum(sample) / len(sample))) + 1
+    return rows
+
+
+def find_segments(csv_file, data_start, workers):
+    """
+    Split the data rows of csv_file into at most `workers` byte ranges.  Every boundary
+    is moved forward to the start of the next line, so no row is ever split in two.
+    """
+    file_size = os.path.getsize(csv_file)
+    segment_size = max(1, (file_size - data_start) // workers)
+    boundaries = [data_start]
+    with open(csv_file, 'rb') as f:
+        for segment_number in range(1, workers):
+            f.seek(data_start + segment_number * segment_size)
+            f.readline()  # skip ahead to the start of the next full line
+            boundary = f.tell()
+            if boundaries[-1] < boundary < file_size:
+                boundaries.append(boundary)
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+class SegmentLines(object):
+    """
+    Iterates over the lines that begin within byte range [start, end) of a plain csv file,
+    splitting them straight out of an mmap of the file rather than through a buffered reader.
+    `position` is the byte offset just past the last line handed out, which csv.reader
+    only asks for when it needs it, so after each row it is the offset where that row ends.
+    """
+
+    def __init__(self, csv_file, start, end):
+        self.csv_file = csv_file
+        self.position = start
+        self.end = end
+
+    def __iter__(self):
+        if self.position >= self.end:
+            return
+        with open(self.csv_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            find = mm.find
+            file_size = len(mm)
+            while self.position < self.end:
+                newline = find(b'\n', self.position)
+                line_end = newline + 1 if newline >= 0 else file_size
+                line = mm[self.position:line_end]
+                if not line:
+                    break
+                self.position = line_end
+                yield line.decode('utf-8')
+
+
+class StreamLines(object):
+    """
+    Iterates over the lines of a compressed file or standard input, from (decompressed) byte
+    offset start up to end, or to the end of the stream.  A background thread reads ahead by
+    up to STREAM_READ_AHEAD chunks, so decompression (which releases the GIL) overlaps with
+    parsing.  `position` works as it does for SegmentLines.
+    """
+
+    def __init__(self, source, start, end=None):
+        self.source = source
+        self.position = start
+        self.end = end
+
+    def _read(self, chunks, stop):
+        def put(chunk):
+            while not stop.is_set():
+                try:
+                    chunks.put(chunk, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            with self.source.open_stream() as stream:
+                # a compressed stream can only be moved forward by decompressing up to the offset
+                to_skip = self.position - self.source.data_start
+                while to_skip > 0:
+                    skipped = len(stream.read(min(to_skip, STREAM_CHUNK_SIZE)))
+                    if not skipped:
+                        break
+                    to_skip -= skipped
+                while True:
+                    chunk = stream.read(STREAM_CHUNK_SIZE)
+                    if not put(chunk) or not chunk:
+                        return
+        except Exception as e:
+            put(e)
+
+    def __iter__(self):
+        chunks = queue.Queue(maxsize=STREAM_READ_AHEAD)
+        stop = threading.Event()
+        threading.Thread(target=self._read, args=(chunks, stop), daemon=True).start()
+        remainder = b''
+        try:
+            while True:
+                chunk = chunks.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if not chunk:
+                    if remainder and (self.end is None or self.position < self.end):
+                        self.position += len(remainder)
+                        yield remainder.decode('utf-8')
+                    return
+                lines = (remainder + chunk).split(b'\n')
+                remainder = lines.pop()
+                for line in lines:
+                    if self.end is not None and self.position >= self.end:
+                        return
+                    self.position += len(line) + 1
+                    yield line.decode('utf-8') + '\n'
+        finally:
+            stop.set()
+
+
+def plan_segments(sources, workers):
+    """
+    Split the sources into (source, start, end) segments.  Plain files get a share of the workers
+    in proportion to their size, each compressed file and standard input a single segment that
+    runs to the end of the stream (end None).
+    """
+    plain_size = sum(source.size for source in sources if source.seekable) or 1
+    segments = []
+    for source in sources:
+        if source.seekable:
+            share = max(1, round(workers * source.size / plain_size))
+            segments.extend((source, start, end) for start, end in find_segments(source.path, source.data_start, share))
+        else:
+            segments.append((source, source.data_start, None))
+    return segments
+
+
+class Checkpoint(object):
+    """
+    The file and byte range of each segment, along with the offset and row count up to which
+    its rows have been flushed to DynamoDB.  With a path, it is saved as JSON every
+    CHECKPOINT_INTERVAL seconds so that an interrupted import can pick up where it left off.
+    """
+
+    def __init__(self, path, sources, segments):
+        self.path = path
+        self.sources = {source.path: source for source in sources}
+        self.segments = [
+            {'csv': source.path, 'start': start, 'end': end, 'offset': start, 'rows': 0,
+             'done': end is not None and start >= end}
+            for source, start, end in segments
+        ]
+        self.saved = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, sources):
+        with open(path) as f:
+            saved = json.load(f)
+        file_sizes = {source.path: source.size for source in sources}
+        if saved['files'] != file_sizes:
+            print(f"\nCheckpoint {path} was written for different csv files, or they have changed size.  "
+                  f"Refusing to resume.\n")
+            raise SystemExit
+        checkpoint = cls(path, sources, [])
+        checkpoint.segments = saved['segments']
+        return checkpoint
+
+    def pending(self):
+        """ Numbers of the segments that still have rows left to import """
+        return [number for number, segment in enumerate(self.segments) if not segment['done']]
+
+    def rows(self):
+        return sum(segment['rows'] for segment in self.segments)
+
+    def update(self, segment_number, offset, rows, done=False):
+        """ Record that a segment is flushed up to offset, and save if it is time to """
+        with self.lock:
+            self.segments[segment_number]['offset'] = offset
+            self.segments[segment_number]['rows'] = rows
+            self.segments[segment_number]['done'] = done
+            if time.monotonic() - self.saved >= CHECKPOINT_INTERVAL:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        self.saved = time.monotonic()
+        if not self.path:
+            return
+        # write to a temporary file and rename it, so a crash never leaves half a checkpoint behind
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            files = {path: source.size for path, source in self.sources.items()}
+            json.dump({'files': files, 'segments': self.segments}, f, indent=4)
+        os.replace(temp_path, self.path)
+
+
+class BloomFilter(object):
+    """ Fixed size set of strings that can say "definitely not seen" or "probably seen" """
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / max(capacity, 1) * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, value):
+        """ Add value, and return True if it was probably already in the filter """
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        # double hashing: the k bit positions are h1 + i*h2
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        present = True
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.size
+            mask = 1 << (bit & 7)
+            if not self.bits[bit >> 3] & mask:
+                present = False
+                self.bits[bit >> 3] |= mask
+        return present
+
+
+def make_key_function(header, key_names):
+    """ Return a function that gets the key of a row as one string, from the columns named key_names """
+    columns = [name.lower() for name in header]
+    key_indices = []
+    for key_name in key_names:
+        if key_name.lower() not in columns:
+            print(f"\nKey attribute '{key_name}' is not a column in the csv file.\n")
+            raise SystemExit
+        key_indices.append(columns.index(key_name.lower()))
+    if len(key_indices) == 1:
+        return operator.itemgetter(key_indices[0])
+    get_cells = operator.itemgetter(*key_indices)
+    return lambda row: '\x00'.join(get_cells(row))
+
+
+def scan_rows(sources, description):
+    """ Generator for every row of the sources, along with its source and the offset where it ends """
+    with tqdm(desc=description, unit=' rows') as progress:
+        for source in sources:
+            lines = source.lines(source.data_start)
+            for row in csv.reader(lines, delimiter=','):
+                progress.update()
+                if row:
+                    yield row, source, lines.position
+
+
+def scan_keys(sources, key_of, description):
+    """ Generator for the key and position (file and end offset) of every row in the sources """
+    for row, source, offset in scan_rows(sources, description):
+        try:
+            key = key_of(row)
+        except IndexError:
+            print(f"\n{source.path}, line {source.line_number(offset - 1)}: the row is missing a key column\n")
+            raise SystemExit
+        # a table has at most two key attributes, so an empty one leaves an empty key or a leading or trailing separator
+        if not key or key.startswith('\x00') or key.endswith('\x00'):
+            print(f"\n{source.path}, line {source.line_number(offset - 1)}: a key column is empty\n")
+            raise SystemExit
+        yield key, (source.path, offset)
+
+
+def find_duplicate_keys(sources, key_of):
+    """
+    Find every key that appears on more than one row of the sources.
+
+    Up to EXACT_DEDUP_ROWS rows, the first row offset of every key is kept in a dictionary.
+    Larger files are scanned twice: first through a Bloom filter, keeping only the keys it has
+    probably seen before as candidates, then again to count the candidates exactly, so memory
+    grows with the number of duplicates rather than with the number of rows.
+
+    :return: dictionary of each duplicated key to the positions of its rows, in file order
+    """
+    estimated_rows = estimate_rows(sources)
+    duplicates = {}
+
+    if estimated_rows <= EXACT_DEDUP_ROWS:
+        first_positions = {}
+        for key, position in scan_keys(sources, key_of, 'Checking keys'):
+            first_position = first_positions.setdefault(key, position)
+            if first_position != position:
+                duplicates.setdefault(key, [first_position]).append(position)
+        return duplicates
+
+    # leave some headroom, as the estimate is only based on the first lines of the file
+    bloom = BloomFilter(int(estimated_rows * 1.25), BLOOM_ERROR_RATE)
+    candidates = set()
+    for key, position in scan_keys(sources, key_of, 'Checking keys (pass 1 of 2)'):
+        if bloom.add(key):
+            candidates.add(key)
+    del bloom
+
+    for key, position in scan_keys(sources, key_of, 'Checking keys (pass 2 of 2)'):
+        if key in candidates:
+            duplicates.setdefault(key, []).append(position)
+    return {key: positions for key, positions in duplicates.items() if len(positions) > 1}
+
+
+class DuplicateFilter(object):
+    """ Decides which of the rows sharing a key gets written: the first one (skip) or the last (last-wins) """
+
+    def __init__(self, key_of, duplicates, on_duplicate):
+        self.key_of = key_of
+        keep = 0 if on_duplicate == 'skip' else -1
+        self.keep_positions = {key: positions[keep] for key, positions in duplicates.items()}
+
+    def skip(self, row, position):
+        keep_position = self.keep_positions.get(self.key_of(row))
+        return keep_position is not None and keep_position != position
+
+
+def report_progress(progress, rows):
+    with progress_lock:
+        progress.update(rows)
+
+
+def get_table_wcu(table_description):
+    """ Return the provisioned WCU of the table, or None if it uses on-demand capacity """
+    billing_mode = table_description.get('BillingModeSummary', {}).get('BillingMode')
+    write_capacity = table_description.get('ProvisionedThroughput', {}).get('WriteCapacityUnits')
+    if billing_mode == 'PAY_PER_REQUEST' or not write_capacity:
+        return None
+    return write_capacity
+
+
+def get_key_types(table_description):
+    """ Return a dictionary of the table's key attribute names and their types (S, N or B) """
+    attribute_types = {a['AttributeName']: a['AttributeType'] for a in table_description['AttributeDefinitions']}
+    return {k['AttributeName']: attribute_types[k['AttributeName']] for k in table_description['KeySchema']}
+
+
+def get_partition_key(table_description):
+    """ Return the name of the table's partition (HASH) key attribute """
+    return next(k['AttributeName'] for k in table_description['KeySchema'] if k['KeyType'] == 'HASH')
+
+
+def interleave(window):
+    """
+    Reorder a window of (partition key, item, units) entries so that consecutive entries take
+    turns between groups of hashed partition keys.  Rows sorted by key, or the many rows of one
+    partition key in a table with a sort key, are spread out instead of arriving one after another.
+    """
+    groups = {}
+    for entry in window:
+        groups.setdefault(hash(entry[0]) % SCHEDULE_BUCKETS, []).append(entry)
+    return [entry for turn in itertools.zip_longest(*groups.values()) for entry in turn if entry is not None]
+
+
+def parse_column_types(text):
+    """ Parse a --types value such as "age=N,active=BOOL" into a dictionary of column name to type """
+    column_types = {}
+    for column_type in text.split(','):
+        name, _, type_code = column_type.partition('=')
+        column_types[name.strip().lower()] = type_code.strip().upper()
+    return column_types
+
+
+def encode_string(value):
+    return {'S': value}
+
+
+def encode_number(value):
+    value = value.strip()
+    try:
+        if Decimal(value).is_finite():
+            return {'N': value}
+    except InvalidOperation:
+        pass
+    raise ValueError(f"'{value}' is not a number")
+
+
+def encode_bool(value):
+    lower_value = value.strip().lower()
+    if lower_value in TRUE_VALUES:
+        return {'BOOL': True}
+    if lower_value in FALSE_VALUES:
+        return {'BOOL': False}
+    raise ValueError(f"'{value}' is not a boolean")
+
+
+def encode_json(value):
+    return to_attribute_value(json.loads(value, parse_float=Decimal, parse_int=Decimal))
+
+
+def to_attribute_value(value):
+    """ Convert a value decoded from JSON into a DynamoDB attribute value """
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, Decimal):
+        return {'N': str(value)}
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, dict):
+        return {'M': {k: to_attribute_value(v) for k, v in value.items()}}
+    return {'L': [to_attribute_value(v) for v in value]}
+
+
+# Column types that can be given with --types, and the function that encodes a cell of each
+COLUMN_ENCODERS = {
+    'S': encode_string,
+    'N': encode_number,
+    'BOOL': encode_bool,
+    'JSON': encode_json,
+}
+
+
+class RowEncoder(object):
+    """
+    Turns csv rows into items in DynamoDB's wire format, ready for client.batch_write_item.
+    The attribute name and encoder for every column are worked out once from the header,
+    so encoding a row is a single pass over its cells.
+    """
+
+    def __init__(self, header, column_types, key_names=()):
+        self.columns = []
+        for name in header:
+            attribute_name = name.lower()
+            self.columns.append((attribute_name, COLUMN_ENCODERS[column_types.get(attribute_name, 'S')]))
+        # added to the size of a row in the csv file to estimate the size of its item
+        self.names_size = sum(len(name.encode('utf-8')) for name, encode in self.columns)
+        # a row too short to reach every key column can't be written
+        names = [name for name, encode in self.columns]
+        self.key_indices = [names.index(key_name.lower()) for key_name in key_names if key_name.lower() in names]
+        self.min_cells = max(self.key_indices, default=-1) + 1
+
+    def encode(self, row):
+        if len(row) < self.min_cells:
+            raise IndexError('the row is missing a key column')
+        for index in self.key_indices:
+            if not row[index]:
+                raise ValueError('the key column is empty')
+        # we can not add null values to a dynamodb item, so we skip those
+        return {name: encode(value) for (name, encode), value in zip(self.columns, row) if value}
+
+    def find_error(self, row):
+        """ Return the number and name of the column that stops a row being encoded, and why (for error messages) """
+        for index in self.key_indices:
+            if index >= len(row):
+                return index + 1, self.columns[index][0], f"missing, the row has only {len(row)} columns"
+            if not row[index]:
+                return index + 1, self.columns[index][0], 'the key column is empty'
+        for index, ((name, encode), value) in enumerate(zip(self.columns, row)):
+            try:
+                if value:
+                    encode(value)
+            except ValueError as e:
+                return index + 1, name, str(e)
+        return None, None, 'unknown error'
+
+    def digest(self, row):
+        """ Hash of the row's non-empty cells and their attribute names, whatever the order of the columns """
+        cells = sorted(f"{name}\x1e{value}" for (name, encode), value in zip(self.columns, row) if value)
+        return hashlib.blake2b('\x1f'.join(cells).encode('utf-8'), digest_size=16).digest()
+
+
+def same_attribute_value(old, new):
+    """ Compare two DynamoDB attribute values, treating numbers that are written differently as equal """
+    (old_type, old_data), = old.items()
+    (new_type, new_data), = new.items()
+    if old_type != new_type:
+        return False
+    if old_type == 'N':
+        return Decimal(old_data) == Decimal(new_data)
+    if old_type == 'M':
+        return old_data.keys() == new_data.keys() and all(same_attribute_value(old_data[k], new_data[k]) for k in old_data)
+    if old_type == 'L':
+        return len(old_data) == len(new_data) and all(same_attribute_value(o, n) for o, n in zip(old_data, new_data))
+    return old_data == new_data
+
+
+def same_item(old, new):
+    if old is None or old.keys() != new.keys():
+        return False
+    return old == new or all(same_attribute_value(old[name], new[name]) for name in new)
+
+
+def load_digests(path, key_names, column_types):
+    """
+    Load the content hash of every key, either from a file written by --save-digests, or by
+    hashing the rows of a previous csv file.
+
+    :return: dictionary of key (as returned by make_key_function) to digest
+    """
+    source = CsvSource(path)
+    header = source.header
+    if header and header[-1] == DIGEST_COLUMN:
+        if [name.lower() for name in header[:-1]] != [name.lower() for name in key_names]:
+            print(f"\nThe key columns of {path} do not match the key attributes of the table.\n")
+            raise SystemExit
+        return {'\x00'.join(row[:-1]): bytes.fromhex(row[-1]) for row, _, _ in scan_rows([source], f"Loading {path}")}
+
+    encoder = RowEncoder(header, column_types)
+    key_of = make_key_function(header, key_names)
+    return {key_of(row): encoder.digest(row) for row, _, _ in scan_rows([source], f"Hashing {path}")}
+
+
+class DigestDelta(object):
+    """ Finds changed rows by comparing their digests with those of the previous import """
+
+    # the digests are in memory, so there is nothing to wait for
+    read_ahead = 0
+
+    def __init__(self, digests, key_of, encoder):
+        self.digests = digests
+        self.key_of = key_of
+        self.encoder = encoder
+
+    def changed(self, entries):
+        """ Return the (row, item, units) entries whose row differs from the previous import """
+        return [entry for entry in entries if self.digests.get(self.key_of(entry[0])) != self.encoder.digest(entry[0])]
+
+
+class TableDelta(object):
+    """ Finds changed rows by reading the current items from the table with BatchGetItem """
+
+    # lookups run in a thread of their own, while the worker carries on reading and writing rows
+    read_ahead = LOOKUP_READ_AHEAD
+
+    def __init__(self, client, table_name, key_names):
+        # low level clients, unlike resources, are safe to share between the workers
+        self.client = client
+        self.table_name = table_name
+        self.key_names = key_names
+
+    def key_id(self, item):
+        return tuple(next(iter(item[name].items())) for name in self.key_names)
+
+    def get_items(self, items):
+        """ Return the table's current version of items, by key_id """
+        keys = {}
+        for item in items:
+            keys[self.key_id(item)] = {name: item[name] for name in self.key_names}
+        found = {}
+        request_items = {self.table_name: {'Keys': list(keys.values())}}
+        attempt = 0
+        while request_items:
+            try:
+                response = self.client.batch_get_item(RequestItems=request_items)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_ERRORS + SERVER_ERRORS or attempt >= MAX_RETRIES:
+                    raise
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+            except TRANSPORT_ERRORS:
+                if attempt >= MAX_RETRIES:
+                    raise
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+            for item in response['Responses'].get(self.table_name, []):
+                found[self.key_id(item)] = item
+            request_items = response.get('UnprocessedKeys')
+            if request_items:
+                if attempt >= MAX_RETRIES:
+                    unprocessed = len(request_items[self.table_name]['Keys'])
+                    print(f"\nGave up on BatchGetItem with {unprocessed} keys still unprocessed after {MAX_RETRIES} retries\n")
+                    raise SystemExit
+                logger.debug(f"Retrying {len(request_items[self.table_name]['Keys'])} UnprocessedKeys")
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+        return found
+
+    def changed(self, entries):
+        """ Return the (row, item, units) entries whose item differs from the one in the table """
+        existing = self.get_items(item for row, item, units in entries)
+        return [entry for entry in entries if not same_item(existing.get(self.key_id(entry[1])), entry[1])]
+
+
+def finish_delta(sources, encoder, key_names, key_of, digests_file, previous_digests, duplicate_filter=None):
+    """
+    Read the keys of the sources once more, to save the digest of every row to digests_file (if given)
+    and to take every key that is still in the file out of previous_digests (if given), which
+    leaves the keys that have disappeared since the previous import.  Rows rejected by
+    duplicate_filter were not imported, so their digests are not saved.
+    """
+    output = open(digests_file, 'w', newline='') if digests_file else None
+    writer = csv.writer(output, lineterminator='\n') if output else None
+    try:
+        if writer:
+            writer.writerow(list(key_names) + [DIGEST_COLUMN])
+        for row, source, offset in scan_rows(sources, 'Saving digests' if writer else 'Finding deleted keys'):
+            if duplicate_filter and duplicate_filter.skip(row, (source.path, offset)):
+                continue
+            key = key_of(row)
+            if writer:
+                writer.writerow(key.split('\x00') + [encoder.digest(row).hex()])
+            if previous_digests is not None:
+                previous_digests.pop(key, None)
+    finally:
+        if output:
+            output.close()
+
+
+def backoff_delay(attempt):
+    """ Exponential backoff with full jitter, capped at 20 seconds """
+    return random.uniform(0, min(20, 0.05 * 2 ** attempt))
+
+
+class WriteThrottle(object):
+    """
+    Token bucket shared by all workers, which paces writes to a WCU rate.
+
+    The rate starts at the ceiling (the provisioned WCU, or --max-wcu), is halved whenever
+    DynamoDB throttles us or returns UnprocessedItems, and climbs back towards the ceiling
+    by 5% of the ceiling per second once the throttling stops.
+    """
+
+    def __init__(self, ceiling):
+        self.ceiling = ceiling
+        self.rate = ceiling
+        self.tokens = ceiling
+        self.updated = time.monotonic()
+        self.last_backoff = 0
+        self.last_ramp_up = 0
+        self.backoffs = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        """ Block until `units` WCU may be spent """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # a write larger than the whole bucket is let through once the bucket is full
+                needed = min(units, self.rate)
+                if self.tokens >= needed:
+                    self.tokens -= units
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def backoff(self):
+        """ Halve the rate, at most once per second so that one burst of throttles counts once """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_backoff >= 1:
+                self.rate = max(1, self.rate / 2)
+                self.tokens = min(self.tokens, self.rate)
+                self.last_backoff = now
+                self.backoffs += 1
+
+    def ramp_up(self):
+        """ Raise the rate back towards the ceiling, once per second after the last backoff """
+        with self.lock:
+            now = time.monotonic()
+            if self.rate < self.ceiling and now - max(self.last_backoff, self.last_ramp_up) >= 1:
+                self.rate = min(self.ceiling, self.rate + self.ceiling * 0.05)
+                self.last_ramp_up = now
+
+
+class PacedBatchWriter(object):
+    """
+    Stand-in for table.batch_writer() that calls BatchWriteItem itself, so that every write
+    is paced by the WriteThrottle and every UnprocessedItems or throttling error is seen.
+    """
+
+    def __init__(self, client, table_name, throttle):
+        self.client = client
+        self.table_name = table_name
+        self.throttle = throttle
+        self.requests = []
+        self.units = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+
+    def put(self, item, units):
+        """ Queue a put of an item that is already in DynamoDB's wire format and costs `units` WCU """
+        self.requests.append({'PutRequest': {'Item': item}})
+        self.units += units
+        if len(self.requests) >= BATCH_SIZE:
+            self.flush()
+
+    def delete(self, key):
+        """ Queue a delete of the item with key (in DynamoDB's wire format) """
+        self.requests.append({'DeleteRequest': {'Key': key}})
+        self.units += 1
+        if len(self.requests) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        requests = self.requests
+        units = self.units
+        self.requests = []
+        self.units = 0
+        attempt = 0
+        while requests:
+            self.throttle.acquire(units)
+            try:
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests})
+            except botocore.exceptions.ClientError as e:
+                error_code = e.response['Error']['Code']
+                if error_code not in THROTTLING_ERRORS + SERVER_ERRORS or attempt >= MAX_RETRIES:
+                    raise
+                logger.debug(e)
+                if error_code in THROTTLING_ERRORS:
+                    self.throttle.backoff()
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+            except TRANSPORT_ERRORS as e:
+                # puts and deletes are idempotent, so a batch that may have been written can be sent again
+                if attempt >= MAX_RETRIES:
+                    raise
+                logger.debug(e)
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            units = math.ceil(units * len(unprocessed) / len(requests))
+            requests = unprocessed
+            if requests:
+                self.throttle.backoff()
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+            else:
+                self.throttle.ramp_up()
+
+
+class ImportStopped(Exception):
+    """ Raised in a worker when the import is interrupted, so that its unwritten rows are not flushed """
+
+
+def import_segment(table_name, profile, region, encoder, checkpoint, segment_number, progress, throttle,
+                   duplicate_filter=None, partition_of=None, schedule_window=0, delta=None, stop=None):
+    """
+    Parse the rows of one segment of the input, from its checkpointed offset onwards, and write
+    them to the table.  Each call uses its own session and batch writer, as boto3 resources
+    are not thread safe.  Rows rejected by duplicate_filter are not written.  Once stop is set,
+    the segment is left where its checkpoint last got to.
+
+    With a schedule_window, that many rows are buffered and interleaved by their partition key
+    (given by partition_of) before being written.  With a delta, rows are checked in groups of
+    BATCH_GET_SIZE and only those that changed are written.  While up to delta.read_ahead groups
+    are being checked in a lookup thread, the worker carries on reading and writing rows.
+
+    :return: Counter of rows 'written' and 'unchanged'
+    """
+    session = boto3.session.Session(profile_name=profile, region_name=region)
+    client = session.client('dynamodb', config=BOTO_CONFIG)
+    encode = encoder.encode
+
+    segment = checkpoint.segments[segment_number]
+    source = checkpoint.sources[segment['csv']]
+    rows_before = segment['rows']
+    rows_done = 0
+    unchanged = 0
+    unreported = 0
+    lines = source.lines(segment['offset'], segment['end'])
+    reader = csv.reader(lines, delimiter=',')
+    row_start = lines.position
+    lines_read = 0
+    window = []
+    lookups = []
+    # groups of rows being checked by the delta, oldest first, as (future, rows, end offset, rows_done)
+    pending = deque()
+    lookup_pool = ThreadPoolExecutor(max_workers=1) if delta and delta.read_ahead else None
+
+    with contextlib.ExitStack() as cleanup, PacedBatchWriter(client, table_name, throttle) as batch:
+        if lookup_pool:
+            cleanup.callback(lookup_pool.shutdown, wait=False, cancel_futures=True)
+
+        def write(row, item, units):
+            if schedule_window:
+                window.append((partition_of(row), item, units))
+                if len(window) >= schedule_window:
+                    for _, window_item, window_units in interleave(window):
+                        batch.put(window_item, window_units)
+                    window.clear()
+            else:
+                batch.put(item, units)
+
+        def look_up():
+            group = list(lookups)
+            lookups.clear()
+            if lookup_pool:
+                future = lookup_pool.submit(delta.changed, group)
+            else:
+                future = Future()
+                future.set_result(delta.changed(group))
+            pending.append((future, len(group), lines.position, rows_done))
+            write_looked_up(wait=False)
+
+        def write_looked_up(wait):
+            """ Write the changed rows of the groups whose lookup is done, or of every group if wait """
+            nonlocal unchanged
+            while pending and (wait or pending[0][0].done() or len(pending) > delta.read_ahead):
+                future, group_size, group_end, group_rows_done = pending.popleft()
+                changed = future.result()
+                for entry in changed:
+                    write(*entry)
+                unchanged += group_size - len(changed)
+                if not window and not batch.requests:
+                    checkpoint.update(segment_number, group_end, rows_before + group_rows_done)
+
+        for row in reader:
+
+            if stop is not None and stop.is_set():
+                raise ImportStopped()
+
+            row_size = lines.position - row_start
+            row_start = lines.position
+            row_line = lines_read + 1
+            lines_read = reader.line_num
+
+            if not row:
+                continue
+
+            try:
+                if duplicate_filter and duplicate_filter.skip(row, (source.path, row_start)):
+                    continue
+                item = encode(row)
+            except (ValueError, IndexError):
+                column_number, column_name, error = encoder.find_error(row)
+                line = source.line_number(segment['offset']) + row_line - 1
+                column = f", column {column_number} ({column_name})" if column_number else ''
+                print(f"\n{source.path}, line {line}{column}: {error}\n")
+                raise SystemExit
+
+            # 1 WCU per started KB, estimated from the size of the row plus the attribute names
+            units = (row_size + encoder.names_size + 1023) // 1024
+
+            if delta:
+                lookups.append((row, item, units))
+            else:
+                write(row, item, units)
+
+            rows_done += 1
+            unreported += 1
+
+            if len(lookups) >= BATCH_GET_SIZE:
+                look_up()
+
+            # empty buffers mean every row up to here has been written
+            if not lookups and not pending and not window and not batch.requests:
+                checkpoint.update(segment_number, lines.position, rows_before + rows_done)
+
+            if unreported == PROGRESS_INTERVAL:
+                report_progress(progress, unreported)
+                unreported = 0
+
+        if lookups:
+            look_up()
+        write_looked_up(wait=True)
+        for _, window_item, window_units in interleave(window):
+            batch.put(window_item, window_units)
+
+    checkpoint.update(segment_number, lines.position, rows_before + rows_done, done=True)
+    checkpoint.save()
+    report_progress(progress, unreported)
+    return Counter(written=rows_done - unchanged, unchanged=unchanged)
+
+
 #
 # Main
 #
 
 help_description = '''
-Import CSV data to a DynamoDB Table.  The 1st column must be unique, as it is used as the partition key.
+Import CSV data to a DynamoDB Table.  The csv file must have a column named after each key attribute of the
+table (the partition key, and the sort key if the table has one), and together they must be unique.
 
 If --profile is not specified, the AWS_PROFILE environment variable will be used.
 
@@ -30,6 +1118,47 @@ Examples:
 
     ./dynamodb-import.py --table foo --csv bar.csv
 
+    Split the file into 8 segments and import them in parallel:
+
+        ./dynamodb-import.py --table foo --csv bar.csv --workers 8
+
+    Import every gzip compressed shard of an export, 8 at a time:
+
+        ./dynamodb-import.py --table foo --csv 'export/part-*.csv.gz' --workers 8
+
+    Import from standard input (which may be compressed as well):
+
+        zcat bar.csv.gz | ./dynamodb-import.py --table foo --csv -
+
+    Leave write capacity for other users of the table by capping the import at 200 WCU:
+
+        ./dynamodb-import.py --table foo --csv bar.csv --workers 8 --max-wcu 200
+
+    Record progress as the import goes, and rerun the same command to resume after a failure:
+
+        ./dynamodb-import.py --table foo --csv bar.csv --workers 8 --checkpoint bar.checkpoint
+
+    Store the "age" column as a number, "active" as a boolean and "address" (a JSON object) as a map:
+
+        ./dynamodb-import.py --table foo --csv bar.csv --types age=N,active=BOOL,address=JSON
+
+    Check for rows with the same key first, and only import the first row for each key:
+
+        ./dynamodb-import.py --table foo --csv bar.csv --on-duplicate skip
+
+    Spread the writes of a file sorted by key across partitions, 5000 rows at a time:
+
+        ./dynamodb-import.py --table foo --csv bar.csv --schedule-window 5000
+
+    Only write the rows that differ from what is in the table now:
+
+        ./dynamodb-import.py --table foo --csv bar.csv --delta table
+
+    Nightly import that only writes rows changed since last night, and deletes items whose rows are gone:
+
+        ./dynamodb-import.py --table foo --csv today.csv --delta yesterday.digests --delete-missing \\
+            --save-digests today.digests
+
 ---------------------------------------------------------------------------
 
 '''
@@ -50,9 +1179,77 @@ parser.add_argument(
 
 parser.add_argument(
     '--csv',
-    help='CSV file containing data to import.\n'
-         'First column name is the partition key.\n'
-         'Additional column names should correspond to item fields.\n')
+    nargs='+',
+    help='CSV file(s) containing data to import: paths, glob patterns, or - for standard input.\n'
+         'gzip, bzip2 and zstd compressed files are decompressed on the fly.\n'
+         'Must have a column for the partition key (and sort key, if any) of the table.\n'
+         'Additional column names should correspond to item fields.\n'
+         'Every file must have the same header.\n')
+
+parser.add_argument(
+    '--types',
+    help='Comma separated column=TYPE pairs giving how to store each column, where TYPE is one of:\n'
+         '  S     string (the default)\n'
+         '  N     number\n'
+         '  BOOL  boolean (true/false, yes/no, 1/0)\n'
+         '  JSON  a JSON object or array, stored as a map or list\n'
+         'Key columns default to the key attribute types of the table.\n')
+
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=1,
+    help='Number of parallel workers (default 1).\n'
+         'Plain files are split into byte-range segments on line boundaries, so\n'
+         'quoted values must not contain embedded newlines when using more than 1.\n'
+         'Each compressed file (and standard input) is read by a single worker.\n')
+
+parser.add_argument(
+    '--max-wcu',
+    type=int,
+    help='Never write faster than this many WCU per second.\n'
+         'By default writes are paced to the provisioned WCU of the table\n'
+         '(or %d WCU for on-demand tables), and slowed down on throttling.\n' % ON_DEMAND_WCU)
+
+parser.add_argument(
+    '--checkpoint',
+    help='File to record import progress in.\n'
+         'If the file already exists, the import resumes from the offsets saved in it\n'
+         '(using the segments saved in it, however --workers has changed).\n')
+
+parser.add_argument(
+    '--on-duplicate',
+    choices=['skip', 'last-wins', 'error'],
+    help='Check the whole file for rows with the same key before importing, and then:\n'
+         '  skip       import only the first row for each key\n'
+         '  last-wins  import only the last row for each key\n'
+         '  error      list the duplicate keys and import nothing\n'
+         'Without this option there is no check; a batch with a repeated key will fail,\n'
+         'and repeated keys in different batches overwrite each other.\n')
+
+parser.add_argument(
+    '--schedule-window',
+    type=int,
+    default=0,
+    help='Buffer this many rows per worker and interleave them by hashed partition key, so that\n'
+         'consecutive batches spread across the keyspace instead of hammering one partition\n'
+         '(rounded up to a multiple of %d; default 0, which writes rows in file order).\n' % BATCH_SIZE)
+
+parser.add_argument(
+    '--delta',
+    help='Only write rows whose content has changed, compared with either:\n'
+         '  table  the items in the table, read with BatchGetItem (%d keys at a time)\n'
+         '  FILE   a --save-digests file, or the previous csv file, from an earlier import\n'
+         '         (the digest of every key is held in memory)\n' % BATCH_GET_SIZE)
+
+parser.add_argument(
+    '--delete-missing',
+    action='store_true',
+    help='With --delta FILE, delete the items whose keys are in FILE but no longer in --csv')
+
+parser.add_argument(
+    '--save-digests',
+    help='Save the key and content digest of every row to this file, for --delta next time')
 
 args = parser.parse_args()
 
@@ -60,9 +1257,17 @@ profile = args.profile
 region = args.region
 
 dynamodb_table = args.table
-csv_file = args.csv
+csv_files = args.csv
+column_types = parse_column_types(args.types) if args.types else {}
+workers = args.workers
+max_wcu = args.max_wcu
+checkpoint_file = args.checkpoint
+on_duplicate = args.on_duplicate
+delta_source = args.delta
+delete_missing = args.delete_missing
+digests_file = args.save_digests
 
-if not csv_file:
+if not csv_files:
     print("\nMust specify --csv parameter.  Use --help to show full usage info.\n")
     raise SystemExit
 
@@ -70,40 +1275,167 @@ if not dynamodb_table:
     print("\nMust specify --table parameter.  Use --help to show full usage info.\n")
     raise SystemExit
 
-# TODO: Put some exception handling around the boto3 calls
-dynamodb = boto3.resource('dynamodb', region_name=region)
+if workers < 1:
+    print("\n--workers must be at least 1.  Use --help to show full usage info.\n")
+    raise SystemExit
 
-table = dynamodb.Table(dynamodb_table)
+if args.schedule_window < 0:
+    print("\n--schedule-window must not be negative.  Use --help to show full usage info.\n")
+    raise SystemExit
 
-# Header (the column names in the csv file)
-header = []
+# a whole number of batches, so the writer is always empty after a window and the checkpoint can advance
+schedule_window = -(-args.schedule_window // BATCH_SIZE) * BATCH_SIZE
 
-# Open csv
-with open(csv_file, newline='') as csvfile:
-    reader = csv.reader(csvfile, delimiter=',')
+if delete_missing and (not delta_source or delta_source == 'table'):
+    print("\n--delete-missing needs --delta with a digest or csv file.  Use --help to show full usage info.\n")
+    raise SystemExit
 
-    # Parse Each Line
-    with table.batch_writer() as batch:
-        for row_index, row in enumerate(tqdm(reader)):
+if max_wcu is not None and max_wcu < 1:
+    print("\n--max-wcu must be at least 1.  Use --help to show full usage info.\n")
+    raise SystemExit
 
-            if row_index == 0:
-                # save the column names to be used as the field names
-                header = row
-            else:
+for column, type_code in column_types.items():
+    if type_code not in COLUMN_ENCODERS:
+        print(f"\nUnknown type '{type_code}' for column '{column}' in --types.  Use --help to show full usage info.\n")
+        raise SystemExit
 
-                if row == "":
-                    continue
+csv_files = expand_paths(csv_files)
+
+if '-' in csv_files and (checkpoint_file or on_duplicate or digests_file or delete_missing):
+    print("\n--checkpoint, --on-duplicate, --save-digests and --delete-missing read the input more than once,\n"
+          "so they can not be used with standard input.\n")
+    raise SystemExit
+
+# Header (the column names in the csv file), always read from the start of each file, even when resuming
+sources = [CsvSource(path) for path in csv_files]
+header = sources[0].header
+
+for source in sources[1:]:
+    if [name.lower() for name in source.header] != [name.lower() for name in header]:
+        print(f"\nThe header of {source.path} does not match the header of {sources[0].path}.\n")
+        raise SystemExit
+
+for column in column_types:
+    if column not in (name.lower() for name in header):
+        print(f"\nColumn '{column}' in --types is not in the header of the csv file.\n")
+        raise SystemExit
+
+if checkpoint_file and os.path.exists(checkpoint_file):
+    checkpoint = Checkpoint.load(checkpoint_file, sources)
+    print(f"Resuming from checkpoint {checkpoint_file}: {checkpoint.rows()} rows already imported")
+else:
+    checkpoint = Checkpoint(checkpoint_file, sources, plan_segments(sources, workers))
+
+pending_segments = checkpoint.pending()
+rows_before = checkpoint.rows()
+
+try:
+    session = boto3.session.Session(profile_name=profile, region_name=region)
+    table_description = session.client('dynamodb').describe_table(TableName=dynamodb_table)['Table']
+except botocore.exceptions.ProfileNotFound:
+    print(f"ERROR: Profile {profile} not found in your ~/.aws/credentials file")
+    raise SystemExit
+except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+    print(f"\nERROR: {e}\n")
+    raise SystemExit
+table_wcu = get_table_wcu(table_description)
+
+# key attributes must be sent with the type the table declares for them, unless --types says otherwise
+for key_name, key_type in get_key_types(table_description).items():
+    if key_type in COLUMN_ENCODERS:
+        column_types.setdefault(key_name.lower(), key_type)
+
+encoder = RowEncoder(header, column_types, get_key_types(table_description))
+
+# also checks that there is a column for every key attribute
+key_of = make_key_function(header, get_key_types(table_description))
+partition_of = make_key_function(header, [get_partition_key(table_description)])
+
+duplicate_filter = None
+if on_duplicate:
+    duplicates = find_duplicate_keys(sources, key_of)
+    duplicate_rows = sum(len(positions) - 1 for positions in duplicates.values())
+    if duplicates:
+        print(f"Found {len(duplicates)} keys on more than one row ({duplicate_rows} extra rows), e.g.:")
+        for key in list(duplicates)[:10]:
+            print(f"    {key.replace(chr(0), ' / ')}  ({len(duplicates[key])} rows)")
+        if on_duplicate == 'error':
+            print("\nNothing imported.  Remove the duplicates, or use --on-duplicate skip or last-wins.\n")
+            raise SystemExit
+        print(f"Skipping the {duplicate_rows} extra rows, keeping the {'first' if on_duplicate == 'skip' else 'last'} row for each key")
+        duplicate_filter = DuplicateFilter(key_of, duplicates, on_duplicate)
+    else:
+        print("No duplicate keys found")
+
+if table_wcu:
+    print(f"Table {dynamodb_table} is provisioned with {table_wcu} WCU")
+    write_ceiling = min(table_wcu, max_wcu or table_wcu)
+else:
+    print(f"Table {dynamodb_table} uses on-demand capacity")
+    write_ceiling = max_wcu or ON_DEMAND_WCU
+
+print(f"Pacing writes to at most {write_ceiling} WCU per second")
+throttle = WriteThrottle(write_ceiling)
+
+key_types = get_key_types(table_description)
+previous_digests = None
+delta = None
+if delta_source == 'table':
+    # shared by the lookup thread of every worker
+    lookup_config = BOTO_CONFIG.merge(Config(max_pool_connections=max(10, workers)))
+    delta = TableDelta(session.client('dynamodb', config=lookup_config), dynamodb_table, list(key_types))
+elif delta_source:
+    previous_digests = load_digests(delta_source, list(key_types), column_types)
+    delta = DigestDelta(previous_digests, key_of, encoder)
+
+start_time = time.time()
+stop = threading.Event()
+
+with tqdm(unit=' rows', initial=rows_before) as progress:
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending_segments)))) as executor:
+        futures = [
+            executor.submit(import_segment, dynamodb_table, profile, region, encoder,
+                            checkpoint, segment_number, progress, throttle, duplicate_filter,
+                            partition_of, schedule_window, delta, stop)
+            for segment_number in pending_segments
+        ]
+        try:
+            # in order of completion, so that a failed segment is seen while the others are still running
+            counts = sum((future.result() for future in as_completed(futures)), Counter())
+        except BaseException as e:
+            # Ctrl-C or a failed segment: stop the running segments at their next row, and drop the
+            # ones that haven't started
+            stop.set()
+            executor.shutdown(cancel_futures=True)
+            checkpoint.save()
+            if not isinstance(e, (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError)):
+                raise
+            print(f"\nERROR: {e}\n")
+            if checkpoint_file:
+                print(f"Run the same command again to resume from checkpoint {checkpoint_file}\n")
+            else:
+                print("Use --checkpoint to be able to resume an import that fails part way through\n")
+            raise SystemExit(1)
 
-                # Create JSON Object (build a Dictionary) and push to DynamoDB
-                data = {}
+checkpoint.save()
 
-                # Iterate over each column
-                for field_index, entry in enumerate(header):
-                    # we can not add null values to a dynamodb item, so we skip those
-                    if row[field_index]:
-                        data[entry.lower()] = row[field_index]
+if digests_file or delete_missing:
+    finish_delta(sources, encoder, list(key_types), key_of, digests_file,
+                 previous_digests if delete_missing else None, duplicate_filter)
 
-                response = batch.put_item(
-                   Item=data
-                )
+if delete_missing and previous_digests:
+    print(f"Deleting {len(previous_digests)} items whose keys are no longer in the csv files")
+    with PacedBatchWriter(session.client('dynamodb', config=BOTO_CONFIG), dynamodb_table, throttle) as batch:
+        for key in previous_digests:
+            key_cells = key.split('\x00')
+            batch.delete({name: COLUMN_ENCODERS[column_types.get(name.lower(), 'S')](cell)
+                          for name, cell in zip(key_types, key_cells)})
+            counts['deleted'] += 1
 
+total_rows = counts['written'] + counts['unchanged']
+elapsed = time.time() - start_time
+print(f"Imported {total_rows} rows in {elapsed:.1f} seconds ({total_rows / max(elapsed, 0.001):.0f} rows/sec)")
+if delta:
+    print(f"Written: {counts['written']}  Unchanged (skipped): {counts['unchanged']}  Deleted: {counts['deleted']}")
+if throttle.backoffs:
+    print(f"Backed off {throttle.backoffs} times due to throttling; final rate {throttle.rate:.0f} WCU per second")
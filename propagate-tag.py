@@ -2,8 +2,39 @@
 
 import sys
 import argparse
-import boto3
+import threading
+import collections
 import botocore.exceptions
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from tag_targets import ThreadOutput, get_sessions, get_targets, run_targets, print_target_summary
+
+# Throttled Describe calls are left to botocore, with more patience than its default of 3 attempts
+BOTO_CONFIG = Config(retries={'mode': 'standard', 'total_max_attempts': 10})
+
+# Most values accepted in one Describe filter.  Above this many instances (or volumes), every
+# volume (or snapshot) of the account is listed and joined in memory instead.
+FILTER_BATCH_SIZE = 200
+
+# Most resources CreateTags accepts in one call
+CREATE_TAGS_BATCH_SIZE = 1000
+
+# CreateTags errors caused by some of the resources of a batch (gone, or not a valid ID), rather than by
+# the call as a whole; on these the batch is split in two to find the resources at fault
+INVALID_ID_ERRORS = (
+    'InvalidID',
+    'InvalidVolume.NotFound',
+    'InvalidVolumeID.Malformed',
+    'InvalidSnapshot.NotFound',
+    'InvalidSnapshotID.Malformed',
+)
+
+# What propagating a tag does to a volume or snapshot that has a different value for it:
+# overwrite it with the instance's value, or only fill in the tag where it is missing
+TAG_POLICIES = ('overwrite', 'fill')
+
+# Tag statuses counted for each tag key
+TAG_STATUSES = ('Match', 'Differs', 'Missing on Instance')
 
 #
 # Helper Functions
@@ -28,17 +59,85 @@ def search_for_tag(list_of_dicts, search_tag):
         return None
 
 
-def set_tag(resource, key, value):
-    """ set EBS volume or snapshot tag key to value """
-    # print(f"DEBUG: Setting tag '{key}' to '{value}'")
-    resource.create_tags(Tags=[{'Key': str(key), 'Value': str(value)}])
+def describe_all(ec2, operation, result_key, filters, batch_filter=None, batch_values=None, **kwargs):
+    """
+    Return every item of a paginated Describe call.  If batch_filter is given, the call is made
+    for each FILTER_BATCH_SIZE of batch_values in turn, with a filter on them added to filters.
+    """
+    paginator = ec2.get_paginator(operation)
+    if batch_filter is None:
+        batches = [filters]
+    else:
+        batch_values = list(batch_values)
+        batches = [filters + [{'Name': batch_filter, 'Values': batch_values[n:n + FILTER_BATCH_SIZE]}]
+                   for n in range(0, len(batch_values), FILTER_BATCH_SIZE)]
+
+    items = []
+    for batch in batches:
+        for page in paginator.paginate(Filters=batch, **kwargs):
+            if result_key == 'Instances':
+                for reservation in page['Reservations']:
+                    items.extend(reservation['Instances'])
+            else:
+                items.extend(page[result_key])
+    return items
+
+
+class Inventory(object):
+    """
+    The instances, and the EBS volumes and snapshots that belong to them, fetched up front in a
+    few paginated Describe calls and joined in memory: volumes to instances by their attachments,
+    and snapshots to volumes by their volume ID.  Resources are the dictionaries the Describe
+    calls return.
+    """
+
+    def __init__(self, ec2, filters):
+        self.instances = describe_all(ec2, 'describe_instances', 'Instances', filters)
+        instance_ids = [instance['InstanceId'] for instance in self.instances]
+
+        # filtered by instance when there are few enough, otherwise every attached volume
+        if len(instance_ids) <= FILTER_BATCH_SIZE:
+            volumes = describe_all(ec2, 'describe_volumes', 'Volumes', [], 'attachment.instance-id', instance_ids)
+        else:
+            volumes = describe_all(ec2, 'describe_volumes', 'Volumes', [{'Name': 'status', 'Values': ['in-use']}])
+
+        self.volumes_by_instance = collections.defaultdict(list)
+        wanted = set(instance_ids)
+        for volume in volumes:
+            for attachment in volume.get('Attachments', []):
+                if attachment['InstanceId'] in wanted:
+                    self.volumes_by_instance[attachment['InstanceId']].append(volume)
+
+        volume_ids = {volume['VolumeId'] for volumes in self.volumes_by_instance.values() for volume in volumes}
+        if len(volume_ids) <= FILTER_BATCH_SIZE:
+            snapshots = describe_all(ec2, 'describe_snapshots', 'Snapshots', [], 'volume-id', sorted(volume_ids),
+                                     OwnerIds=['self'])
+        else:
+            snapshots = describe_all(ec2, 'describe_snapshots', 'Snapshots', [], OwnerIds=['self'])
+
+        self.snapshots_by_volume = collections.defaultdict(list)
+        for snapshot in snapshots:
+            if snapshot.get('VolumeId') in volume_ids:
+                self.snapshots_by_volume[snapshot['VolumeId']].append(snapshot)
+
+    def volumes(self, instance):
+        return self.volumes_by_instance.get(instance['InstanceId'], [])
+
+    def snapshots(self, volume):
+        return self.snapshots_by_volume.get(volume['VolumeId'], [])
+
+
+def set_tags(ec2, resource_ids, tags):
+    """ set EBS volume or snapshot tags, (key, value) pairs, on up to CREATE_TAGS_BATCH_SIZE resources at once """
+    # print(f"DEBUG: Setting tags {tags} on {len(resource_ids)} resources")
+    ec2.create_tags(Resources=list(resource_ids), Tags=[{'Key': str(key), 'Value': str(value)} for key, value in tags])
 
 
 def tag_match(instance, resource, tag_key):
     """ given volume or snapshot resource, check if the instance tag value matches that resource's tag value """
 
-    instance_tag_value = search_for_tag(instance.tags, tag_key)
-    resource_tag_value = search_for_tag(resource.tags, tag_key)
+    instance_tag_value = search_for_tag(instance.get('Tags'), tag_key)
+    resource_tag_value = search_for_tag(resource.get('Tags'), tag_key)
 
     if instance_tag_value == resource_tag_value:
         return True
@@ -46,101 +145,230 @@ def tag_match(instance, resource, tag_key):
         return False
 
 
-def print_volume_tag_status(instance, volume, tag_key):
-    if search_for_tag(instance.tags, tag_key):
-        if tag_match(instance, volume, tag_key):
-            tag_status = 'Match'
-        else:
-            tag_status = 'Differs'
-    else:
+def tag_status(instance, resource, tag_key):
+    """ given volume or snapshot resource, return one of TAG_STATUSES """
+    if not search_for_tag(instance.get('Tags'), tag_key):
         # Given tag_key not defined for the instance
-        tag_status = 'Missing on Instance'
-    print(f"{instance.id}  {volume.id}                          {tag_status}")
+        return 'Missing on Instance'
+    if tag_match(instance, resource, tag_key):
+        return 'Match'
+    return 'Differs'
 
 
-def print_snapshot_tag_status(instance, volume, snapshot, tag_key):
-    if search_for_tag(instance.tags, tag_key):
-        if tag_match(instance, snapshot, tag_key):
-            tag_status = 'Match'
-        else:
-            tag_status = 'Differs'
+def print_row(instance, volume, snapshot, statuses):
+    """ Print the status of each tag on a volume (snapshot None) or snapshot; with several tags, each is named """
+    if len(statuses) == 1:
+        tag_status_text = next(iter(statuses.values()))
     else:
-        # Given tag_key not defined for the instance
-        tag_status = 'Missing on Instance'
-    print(f"{instance.id}  {volume.id}  {snapshot.id}  {tag_status}")
+        tag_status_text = ', '.join(f"{key}: {status}" for key, status in statuses.items())
+    snapshot_id = snapshot['SnapshotId'] if snapshot else '                      '
+    print(f"{instance['InstanceId']}  {volume['VolumeId']}  {snapshot_id}  {tag_status_text}")
+
 
+def print_counts(counts, columns):
+    """ Print the number of volumes and snapshots in each status (columns), for each tag key """
+    width = max(len('Tag Key'), *(len(key) for key in counts))
+    print(f"{'Tag Key':<{width}}" + ''.join(f"  {column:>19}" for column in columns))
+    print('-' * width + '  -------------------' * len(columns))
+    for key, key_counts in counts.items():
+        print(f"{key:<{width}}" + ''.join(f"  {key_counts[column]:>19}" for column in columns))
 
-def print_report(instances, tag_key):
+
+def print_report(inventory, tag_keys):
+    """ Print the report of the status of the tags, and return the counts of each tag key """
+    counts = {key: collections.Counter() for key in tag_keys}
     print(f"-------------------  ---------------------  ----------------------  -------------------")
     print(f"Instance             Volume                 Snapshot                Tag Status")
     print(f"-------------------  ---------------------  ----------------------  -------------------")
-    for i in instances:
-        volumes = i.volumes.all()
-        for v in volumes:
-            print_volume_tag_status(i, v, tag_key)
-            snapshots = v.snapshots.all()
-            for ss in snapshots:
-                print_snapshot_tag_status(i, v, ss, tag_key)
+    for i in inventory.instances:
+        for v in inventory.volumes(i):
+            for ss in [None] + inventory.snapshots(v):
+                statuses = {key: tag_status(i, ss or v, key) for key in tag_keys}
+                for key, status in statuses.items():
+                    counts[key][status] += 1
+                print_row(i, v, ss, statuses)
         print(f"-------------------  ---------------------  ----------------------  -------------------")
-
-
-def propagate_tag_to_volume(instance, volume, tag_key, dry_run):
-    if tag_match(instance, volume, tag_key):
-        tag_status = 'Already Matches'
-    else:
-        old_tag_value = search_for_tag(volume.tags, tag_key) or 'None'
-        new_tag_value = search_for_tag(instance.tags, tag_key)
-        if dry_run:
-            tag_status = f"Differs - Would Update ({old_tag_value} --> {new_tag_value})"
-        else:
-            tag_status = f"Differs - Updating ({old_tag_value} --> {new_tag_value})"
-            set_tag(volume, tag_key, new_tag_value)
-    print(f"{instance.id}  {volume.id}                          {tag_status}")
-
-
-def propagate_tag_to_snapshot(instance, volume, snapshot, tag_key, dry_run):
-    if tag_match(instance, snapshot, tag_key):
-        tag_status = 'Already Matches'
-    else:
-        old_tag_value = search_for_tag(snapshot.tags, tag_key) or 'None'
-        new_tag_value = search_for_tag(instance.tags, tag_key)
-        if dry_run:
-            tag_status = f"Differs - Would Update ({old_tag_value} --> {new_tag_value})"
-        else:
-            tag_status = f"Differs - Updating ({old_tag_value} --> {new_tag_value})"
-            set_tag(snapshot, tag_key, new_tag_value)
-    print(f"{instance.id}  {volume.id}  {snapshot.id}  {tag_status}")
-
-
-def propagate_tag(instances, tag_key, dry_run):
+    return counts
+
+
+def plan_propagation(inventory, tag_policies):
+    """
+    Work out what propagating the tags would change, without changing anything.
+
+    Returns the plan, a list of (instance, rows) where rows is None if the instance has none of the
+    tags, or else a list of (volume, snapshot, tags) for each volume (with snapshot None) and snapshot.
+    tags is a dictionary of each tag key to (status, old value, new value, action), action being one of
+    'match', 'update', 'keep' (differs, but the policy is fill) or 'missing' (not on the instance).
+
+    Also returns the targets: a dictionary of the ID of each volume or snapshot that is to be updated, to
+    the tags it is to be given.  Those include the tags that already match, which makes no difference
+    to the resource, but lets it share a CreateTags call with the other resources of the instance.
+    """
+    plan = []
+    targets = {}
+    for instance in inventory.instances:
+        # If a tag key is defined on the instance, we propagate it to all volumes and snapshots
+        instance_tags = {key: search_for_tag(instance.get('Tags'), key) for key in tag_policies}
+        if not any(instance_tags.values()):
+            plan.append((instance, None))
+            continue
+
+        rows = []
+        for volume in inventory.volumes(instance):
+            for snapshot in [None] + inventory.snapshots(volume):
+                resource = snapshot or volume
+                tags = {}
+                target = []
+                for key, policy in tag_policies.items():
+                    status = tag_status(instance, resource, key)
+                    old_tag_value = search_for_tag(resource.get('Tags'), key)
+                    new_tag_value = instance_tags[key]
+                    if status == 'Missing on Instance':
+                        action = 'missing'
+                    elif status == 'Match':
+                        action = 'match'
+                        target.append((key, new_tag_value))
+                    elif policy == 'fill' and old_tag_value is not None:
+                        action = 'keep'
+                    else:
+                        action = 'update'
+                        target.append((key, new_tag_value))
+                    tags[key] = (status, old_tag_value or 'None', new_tag_value, action)
+                rows.append((volume, snapshot, tags))
+                if any(action == 'update' for _, _, _, action in tags.values()):
+                    targets[resource.get('SnapshotId') or resource['VolumeId']] = tuple(target)
+        plan.append((instance, rows))
+    return plan, targets
+
+
+def apply_changes(ec2, targets, workers, stop):
+    """
+    Tag the resources with CreateTags calls, each for up to CREATE_TAGS_BATCH_SIZE resources that
+    are to get the same tags, made by a pool of workers.  Once stop is set, no more calls are made.
+
+    :return: dictionary of each resource that could not be tagged to the error, and the number of batches
+    """
+    resources_by_tags = collections.defaultdict(list)
+    for resource_id, tags in targets.items():
+        resources_by_tags[tags].append(resource_id)
+
+    batches = [(tags, resource_ids[n:n + CREATE_TAGS_BATCH_SIZE])
+               for tags, resource_ids in resources_by_tags.items()
+               for n in range(0, len(resource_ids), CREATE_TAGS_BATCH_SIZE)]
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_failures in executor.map(lambda batch: apply_batch(ec2, *batch, stop), batches):
+            failures.update(batch_failures)
+    return failures, len(batches)
+
+
+def apply_batch(ec2, tags, resource_ids, stop):
+    """
+    Tag a batch of resources.  If the call fails because of some of the resources, the batch is split
+    in two and each half tried again, to find which of them fail.  Any other error fails the whole batch.
+    """
+    if stop.is_set():
+        return {resource_id: 'Stopped' for resource_id in resource_ids}
+    try:
+        set_tags(ec2, resource_ids, tags)
+        return {}
+    except botocore.exceptions.ClientError as e:
+        error_code = e.response['Error']['Code']
+        if error_code not in INVALID_ID_ERRORS or len(resource_ids) == 1:
+            return {resource_id: error_code for resource_id in resource_ids}
+    except botocore.exceptions.BotoCoreError as e:
+        return {resource_id: str(e) for resource_id in resource_ids}
+
+    half = len(resource_ids) // 2
+    failures = apply_batch(ec2, tags, resource_ids[:half], stop)
+    failures.update(apply_batch(ec2, tags, resource_ids[half:], stop))
+    return failures
+
+
+def propagate_tags(ec2, inventory, tag_policies, dry_run, workers, stop):
+    """ Propagate the tags, print the report of what was done, and return the counts of each tag key """
+    plan, targets = plan_propagation(inventory, tag_policies)
+
+    failures = {}
+    batch_count = 0
+    if targets and not dry_run:
+        failures, batch_count = apply_changes(ec2, targets, workers, stop)
+
+    updated = 'Would Update' if dry_run else 'Updated'
+    counts = {key: collections.Counter() for key in tag_policies}
     print(f"-------------------  ---------------------  ----------------------  -------------------")
     print(f"Instance             Volume                 Snapshot                Tag Status")
     print(f"-------------------  ---------------------  ----------------------  -------------------")
-    for instance in instances:
-        # If the tag_key is defined on the instance, we propagate it to all volumes and snapshots
-        if search_for_tag(instance.tags, tag_key):
-            volumes = instance.volumes.all()
-            for volume in volumes:
-                propagate_tag_to_volume(instance, volume, tag_key, dry_run)
-                snapshots = volume.snapshots.all()
-                for snapshot in snapshots:
-                    propagate_tag_to_snapshot(instance, volume, snapshot, tag_key, dry_run)
-        else:
-            print(f"{instance.id}  --> Tag key '{tag_key}' not defined or has no value.  Skipping.")
+    for instance, rows in plan:
+        if rows is None:
+            tag_keys = "', '".join(tag_policies)
+            print(f"{instance['InstanceId']}  --> Tag key{'s' if len(tag_policies) > 1 else ''} '{tag_keys}' "
+                  f"not defined or has no value.  Skipping.")
+            for volume in inventory.volumes(instance):
+                for key in tag_policies:
+                    counts[key]['Missing on Instance'] += 1 + len(inventory.snapshots(volume))
+
+        for volume, snapshot, tags in rows or []:
+            resource_id = snapshot['SnapshotId'] if snapshot else volume['VolumeId']
+            statuses = {}
+            for key, (status, old_tag_value, new_tag_value, action) in tags.items():
+                counts[key][status] += 1
+                if action == 'missing':
+                    statuses[key] = status
+                elif action == 'match':
+                    statuses[key] = 'Already Matches'
+                elif action == 'keep':
+                    statuses[key] = f"Differs - Kept ({old_tag_value}, fill only)"
+                    counts[key]['Kept'] += 1
+                elif dry_run:
+                    statuses[key] = f"Differs - Would Update ({old_tag_value} --> {new_tag_value})"
+                    counts[key][updated] += 1
+                elif resource_id in failures:
+                    statuses[key] = f"Differs - Update Failed ({old_tag_value} --> {new_tag_value}): {failures[resource_id]}"
+                    counts[key]['Failed'] += 1
+                else:
+                    statuses[key] = f"Differs - Updating ({old_tag_value} --> {new_tag_value})"
+                    counts[key][updated] += 1
+            print_row(instance, volume, snapshot, statuses)
         print(f"-------------------  ---------------------  ----------------------  -------------------")
 
+    if targets and not dry_run:
+        print(f"Updated {len(targets) - len(failures)} volumes and snapshots in {batch_count} CreateTags batches"
+              + (f", {len(failures)} failed" if failures else ''))
+    return counts
+
+
+def parse_tag(text, default_policy):
+    """ Return the key and policy of a KEY or KEY:POLICY tag, as given with --tag or in --tag-file """
+    key, _, policy = text.strip().rpartition(':')
+    if policy in TAG_POLICIES and key:
+        return key, policy
+    return text.strip(), default_policy
+
 
 #
 # Main
 #
 
 help_description = '''
-Propagate a single EC2 Instance Tag to associated EBS Volumes and Snapshots
+Propagate EC2 Instance Tags to associated EBS Volumes and Snapshots
+
+Several tags can be given with --tag, or listed one per line in a --tag-file.  Each tag key may be
+followed by the policy for volumes and snapshots that already have a different value for it:
+
+    KEY:overwrite   replace it with the instance's value (the default, or as given with --policy)
+    KEY:fill        keep it, and only add the tag where it is missing
 
 If --profile is not specified, the AWS_PROFILE environment variable will be used.
 
 If --region is not specified, it will default to "us-east-1"
 
+To run across several regions, give --regions (a comma separated list, or "all" for every region enabled in
+the account).  To run across several accounts, give --accounts; the --role-name role is assumed in each of
+them using the --profile credentials.  Up to --max-targets account/region targets are run at once, and their
+output is printed one target after another, followed by a summary of each target.
+
 ---------------------------------------------------------------------------
 Examples:
 
@@ -164,6 +392,18 @@ Examples:
 
         ./propagate-tags.py --propagate --tag AppName --dry-run
 
+    Propagate several tags in one pass, only filling in Owner where volumes and snapshots don't have it:
+
+        ./propagate-tags.py --propagate --tag AppName CostCenter Owner:fill
+
+    Propagate the tags listed in a file:
+
+        ./propagate-tags.py --propagate --tag-file cost-allocation-tags.txt
+
+    Report on every enabled region of two accounts, assuming the same role in each:
+
+        ./propagate-tags.py --report --tag AppName --regions all --accounts 111111111111,222222222222 --role-name TagAdmin
+
 ---------------------------------------------------------------------------
 
 '''
@@ -178,6 +418,25 @@ parser.add_argument(
     '--region',
     help='AWS Region ID (e.g. us-east-1)')
 
+parser.add_argument(
+    '--regions',
+    help='Comma separated AWS Region IDs, or "all" for every region enabled in the account (overrides --region)')
+
+parser.add_argument(
+    '--accounts',
+    help='Comma separated AWS account IDs, to assume --role-name in')
+
+parser.add_argument(
+    '--role-name',
+    default='OrganizationAccountAccessRole',
+    help='Role assumed in each of --accounts (default OrganizationAccountAccessRole)')
+
+parser.add_argument(
+    '--max-targets',
+    type=int,
+    default=8,
+    help='Number of account/region targets run at once (default 8)')
+
 parser.add_argument(
     '--vpc',
     help='Limit to specific VPC ID (e.g. vpc-51400a36)')
@@ -192,23 +451,41 @@ parser.add_argument(
 
 parser.add_argument(
     '--tag',
-    help='The tag to report on or propagate (required with --report or --propagate)')
+    nargs='+',
+    metavar='KEY[:POLICY]',
+    help='The tags to report on or propagate (--tag or --tag-file required with --report or --propagate)')
+
+parser.add_argument(
+    '--tag-file',
+    help='File listing the tags to report on or propagate, one KEY[:POLICY] per line')
+
+parser.add_argument(
+    '--policy',
+    choices=TAG_POLICIES,
+    default='overwrite',
+    help='Policy of the tags that are not given one (default overwrite)')
 
 parser.add_argument(
     '--report',
     action='store_true',
-    help='Print a report of the current state of given tag (--tag required)')
+    help='Print a report of the current state of given tags (--tag or --tag-file required)')
 
 parser.add_argument(
     '--propagate',
     action='store_true',
-    help='Propagate given EC2 tag to EBS volumes and snapshots (--tag required)')
+    help='Propagate given EC2 tags to EBS volumes and snapshots (--tag or --tag-file required)')
 
 parser.add_argument(
     '--dry-run',
     action='store_true',
     help='Show what would be done, but dont do it.')
 
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=4,
+    help='Number of CreateTags calls made at once when propagating (default 4)')
+
 parser.set_defaults(report=False)
 parser.set_defaults(propagate=False)
 parser.set_defaults(dry_run=False)
@@ -229,7 +506,24 @@ limit_tag_key = args.tag_key
 dry_run = args.dry_run
 report = args.report
 propagate = args.propagate
-tag_key = args.tag
+workers = args.workers
+
+regions = args.regions
+accounts = args.accounts.split(',') if args.accounts else None
+role_name = args.role_name
+max_targets = args.max_targets
+
+tag_specs = list(args.tag or [])
+if args.tag_file:
+    try:
+        with open(args.tag_file) as f:
+            tag_specs.extend(line for line in f if line.strip() and not line.lstrip().startswith('#'))
+    except OSError as e:
+        print(f"\nERROR: Unable to read --tag-file: {e}\n")
+        raise SystemExit
+
+# Each tag key and its policy, in the order given
+tag_policies = dict(parse_tag(spec, args.policy) for spec in tag_specs)
 
 if report and propagate:
     print(f"\nCannot specify both --report and --propagate at the same time!  Use --help to show full usage info.\n")
@@ -239,18 +533,23 @@ if not (report or propagate):
     print(f"\nMust specify either --report or --propagate options!  Use --help to show full usage info.\n")
     raise SystemExit
 
-if not tag_key:
-    print(f"\nMust specify --tag <tag key> to report on or propagate!  Use --help to show full usage info.\n")
+if not tag_policies:
+    print(f"\nMust specify --tag <tag key> or --tag-file to report on or propagate!  Use --help to show full usage info.\n")
+    raise SystemExit
+
+if workers < 1 or max_targets < 1:
+    print(f"\n--workers and --max-targets must be at least 1.  Use --help to show full usage info.\n")
     raise SystemExit
 
 if not region:
     region = 'us-east-1'
 
+client_config = BOTO_CONFIG.merge(Config(max_pool_connections=max(10, workers)))
+
 try:
     # If profile is specified, we use it rather than AWS_PROFILE
-    if profile:
-        boto3.setup_default_session(profile_name=profile)
-    ec2 = boto3.resource('ec2', region_name=region)
+    sessions = get_sessions(profile, accounts, role_name, max_targets, 'propagate-tag')
+    targets = get_targets(sessions, regions, region, client_config)
 except botocore.exceptions.ProfileNotFound as e:
     print(f"ERROR: Profile {profile} not found in your ~/.aws/credentials file")
     raise SystemExit
@@ -272,22 +571,60 @@ if limit_instance_id:
 if limit_tag_key:
     filters.append({'Name': 'tag-key', 'Values': [limit_tag_key]})
 
-instances = []
 
-try:
-    instances = ec2.instances.filter(Filters=filters)
+# Set on Ctrl-C, so that running targets make no more CreateTags calls
+stop = threading.Event()
+
+
+def work(ec2):
+    # Every instance, volume and snapshot is fetched up front, so the report and propagation make no Describe calls
+    inventory = Inventory(ec2, filters)
 
     if report:
-        print_report(instances, tag_key)
+        return print_report(inventory, list(tag_policies))
 
     elif propagate:
-        propagate_tag(instances, tag_key, dry_run)
+        return propagate_tags(ec2, inventory, tag_policies, dry_run, workers, stop)
+
+
+if report:
+    count_columns = TAG_STATUSES
+elif dry_run:
+    count_columns = TAG_STATUSES + ('Would Update', 'Kept')
+else:
+    count_columns = TAG_STATUSES + ('Updated', 'Kept', 'Failed')
+
+sys.stdout = ThreadOutput(sys.stdout)
+results = []
+counts = {}
+
+
+def print_target(target, result):
+    """ Print the output of a target and add up its counts, as soon as it and the targets before it are done """
+    account, target_region, _ = target
+    output, target_counts, seconds, error = result
+    results.append(result)
+    if len(targets) > 1:
+        print(f"\n=== Account {account or 'default'}, Region {target_region} ===\n")
+    print(output, end='')
+    if error:
+        print(f"\nERROR: {error}")
+    for key, key_counts in (target_counts or {}).items():
+        counts.setdefault(key, collections.Counter()).update(key_counts)
+
+
+try:
+    run_targets(targets, work, max_targets, stop, print_target)
 
 except KeyboardInterrupt:
     print(f"\nHow wewd!")
     raise SystemExit
 
-except botocore.exceptions.ClientError as e:
-    print(f"\nERROR: {e}")
-    raise SystemExit
+if counts:
+    print()
+    print_counts(counts, count_columns)
+
+if len(targets) > 1:
+    print()
+    print_target_summary(targets, results)
 
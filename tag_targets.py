@@ -0,0 +1,168 @@
+#
+# Run a tag tool across several regions and accounts: the helpers shared by propagate-tag.py and delete-tag.py
+#
+
+import io
+import sys
+import time
+import threading
+import boto3
+import botocore.credentials
+import botocore.exceptions
+import botocore.session
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ThreadOutput(object):
+    """
+    Stands in for sys.stdout while targets are run in threads.  What a thread prints while it has
+    a buffer goes to the buffer, so that the output of each target can be printed in one piece.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class AssumedRoleProvider(botocore.credentials.CredentialProvider):
+    """
+    Credential provider that gives a session the credentials of a role assumed in another account,
+    from fetch_credentials(), which returns the metadata RefreshableCredentials expects.  The
+    credentials are fetched again shortly before they expire.
+    """
+
+    METHOD = 'assumed-role-in-account'
+
+    def __init__(self, metadata, fetch_credentials):
+        super().__init__()
+        self.credentials = botocore.credentials.RefreshableCredentials.create_from_metadata(
+            metadata, refresh_using=fetch_credentials, method=self.METHOD)
+
+    def load(self):
+        return self.credentials
+
+
+def get_sessions(profile, accounts, role_name, max_targets, session_name):
+    """
+    Return a session for each account, with the role assumed in it, or for the profile itself if no
+    accounts are given (as {None: session}).  Each session is shared by every region of its account.
+    An account whose role can't be assumed gets the error instead of a session.  session_name is
+    the RoleSessionName, which shows up in CloudTrail.
+
+    The role is assumed again whenever its credentials are about to expire, so that targets that
+    only start after an hour (the default AssumeRole lifetime) still have valid credentials.
+    """
+    base_session = boto3.session.Session(profile_name=profile)
+    if not accounts:
+        return {None: base_session}
+    sts = base_session.client('sts')
+
+    def assume_role(account):
+        def fetch_credentials():
+            credentials = sts.assume_role(
+                RoleArn=f"arn:aws:iam::{account}:role/{role_name}",
+                RoleSessionName=session_name)['Credentials']
+            return {
+                'access_key': credentials['AccessKeyId'],
+                'secret_key': credentials['SecretAccessKey'],
+                'token': credentials['SessionToken'],
+                'expiry_time': credentials['Expiration'].isoformat(),
+            }
+
+        # the first credentials are fetched now, so that an account we can't get into fails up front
+        try:
+            metadata = fetch_credentials()
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            return e
+        # ahead of the environment and profile, which would otherwise give the session our own credentials
+        botocore_session = botocore.session.get_session()
+        botocore_session.get_component('credential_provider').insert_before(
+            'env', AssumedRoleProvider(metadata, fetch_credentials))
+        return boto3.session.Session(botocore_session=botocore_session)
+
+    with ThreadPoolExecutor(max_workers=max_targets) as executor:
+        return dict(zip(accounts, executor.map(assume_role, accounts)))
+
+
+def get_targets(sessions, regions, default_region, config):
+    """
+    Return the (account, region, EC2 client) of every target: each region of each account, where
+    regions is "all" (every region enabled in the account), comma separated regions, or None for
+    default_region.  The clients are created with config.  A target that can't be reached gets the
+    error in place of the client.
+    """
+    targets = []
+    for account, session in sessions.items():
+        try:
+            if isinstance(session, Exception):
+                raise session
+            if regions == 'all':
+                ec2 = session.client('ec2', region_name=default_region, config=config)
+                target_regions = sorted(r['RegionName'] for r in ec2.describe_regions()['Regions'])
+            else:
+                target_regions = regions.split(',') if regions else [default_region]
+            for region in target_regions:
+                targets.append((account, region, session.client('ec2', region_name=region, config=config)))
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            targets.append((account, '-', e))
+    return targets
+
+
+def run_target(target, work):
+    """
+    Run work(ec2 client) for a target, in a worker thread, keeping what it prints.  Any exception
+    is returned as the target's error, so that one failed target doesn't stop the others.
+    :return: the output, the result of work, the seconds it took, and the error (or None)
+    """
+    account, region, ec2 = target
+    if isinstance(ec2, Exception):
+        return '', None, 0.0, ec2
+
+    sys.stdout.local.buffer = io.StringIO()
+    start_time = time.monotonic()
+    result = error = None
+    try:
+        result = work(ec2)
+    except Exception as e:
+        error = e
+    finally:
+        output = sys.stdout.local.buffer.getvalue()
+        sys.stdout.local.buffer = None
+    return output, result, time.monotonic() - start_time, error
+
+
+def run_targets(targets, work, max_targets, stop, on_result):
+    """
+    Run work(ec2 client) for every target, up to max_targets at once, and call on_result(target, result)
+    for each of them (with the result of run_target), in the order of targets, as soon as it and the
+    targets before it are done.  On Ctrl-C, or any other error, stop is set so that the running targets
+    end at their next call, and the targets that haven't started are dropped rather than waited for.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_targets)
+    try:
+        for target, result in zip(targets, executor.map(lambda t: run_target(t, work), targets)):
+            on_result(target, result)
+    except BaseException:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+
+def print_target_summary(targets, results):
+    """ Print how long each target took, and its error if it failed """
+    print(f"------------  --------------  --------  ------------------------------------------")
+    print(f"Account       Region          Seconds   Result")
+    print(f"------------  --------------  --------  ------------------------------------------")
+    for (account, region, _), (_, _, seconds, error) in zip(targets, results):
+        print(f"{account or 'default':<12}  {region:<14}  {seconds:>8.1f}  {f'ERROR: {error}' if error else 'OK'}")
+    print(f"------------  --------------  --------  ------------------------------------------")
+    failed = sum(1 for result in results if result[3])
+    print(f"{len(targets)} targets, {failed} failed")